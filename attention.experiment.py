@@ -65,7 +65,7 @@ class SimpleImageLayer(gaussian_temp.HyperLayer):
 
     def __init__(self, in_size, k, adaptive=True, gadditional=0, radditional=0, region=None, sigma_scale=0.1,
                  num_values=-1, min_sigma=0.0,
-                 subsample=None, preprocess=None):
+                 subsample=None, preprocess=None, hyper_cache=None):
 
         ci, hi, wi = in_size
         out_size = co, ho, wo = ci, k, k
@@ -86,7 +86,8 @@ class SimpleImageLayer(gaussian_temp.HyperLayer):
         self.lc_sizes = [(out_size+in_size)[i] for i in self.lc]
 
         super().__init__(in_rank=3, out_size=(co, ho, wo), temp_indices=indices, learn_cols=self.lc,
-                         gadditional=gadditional, radditional=radditional, region=region, subsample=subsample)
+                         gadditional=gadditional, radditional=radditional, region=region, subsample=subsample,
+                         hyper_cache=hyper_cache)
 
         # scale to [0,1] in each dim
         pixel_indices = pixel_indices.float() / torch.FloatTensor([k, k]).unsqueeze(0).expand_as(pixel_indices)
@@ -273,7 +274,8 @@ class SimpleImageLayer(gaussian_temp.HyperLayer):
 class ASHModel(nn.Module):
 
     def __init__(self, shape, k, glimpses,  num_values, min_sigma, subsample, hidden,
-                 num_classes, reinforce=False, gadditional=None, radditional=None, region=None, rfboost=2.0):
+                 num_classes, reinforce=False, gadditional=None, radditional=None, region=None, rfboost=2.0,
+                 hyper_cache=None):
         super().__init__()
 
         self.reinforce = reinforce
@@ -340,7 +342,7 @@ class ASHModel(nn.Module):
             self.hyperlayers.append(SimpleImageLayer(shape, k=k, adaptive=True,
                                             gadditional=gadditional, radditional=radditional, region=region,
                                             num_values=num_values,
-                                            min_sigma=min_sigma, subsample=subsample))
+                                            min_sigma=min_sigma, subsample=subsample, hyper_cache=hyper_cache))
 
         self.lin1 = nn.Linear(k * k * shape[0] * glimpses, hidden)
         self.lin2 = nn.Linear(hidden, num_classes)
@@ -842,7 +844,7 @@ def go(args, batch=64, epochs=350, k=3, modelname='baseline', cuda=False,
         model = ASHModel(shape=shape, k=k, glimpses=args.num_glimpses, num_values=num_values, min_sigma=min_sigma,
                          subsample=subsample, hidden=hidden, num_classes=num_classes,
                          gadditional=args.gadditional, radditional=args.radditional, region=(args.chunk, args.chunk),
-                         reinforce=False)
+                         reinforce=False, hyper_cache=args.hyper_cache)
 
         # model = nn.Sequential(
         #     hyperlayer,
@@ -1019,25 +1021,27 @@ def go(args, batch=64, epochs=350, k=3, modelname='baseline', cuda=False,
 
         model.eval()
 
-        for i, data in enumerate(testloader, 0):
+        # no gradients are needed, and without them the hyperlayers can use their caches (if any)
+        with torch.no_grad():
+            for i, data in enumerate(testloader, 0):
 
-            # get the inputs
-            inputs, labels = data
+                # get the inputs
+                inputs, labels = data
 
-            if cuda:
-                inputs, labels = inputs.cuda(), labels.cuda()
+                if cuda:
+                    inputs, labels = inputs.cuda(), labels.cuda()
 
-            # wrap them in Variables
-            inputs, labels = Variable(inputs), Variable(labels)
+                # wrap them in Variables
+                inputs, labels = Variable(inputs), Variable(labels)
 
-            if not reinforce:
-                outputs = model(inputs)
-            else:
-                outputs, _, _ = model(inputs)
+                if not reinforce:
+                    outputs = model(inputs)
+                else:
+                    outputs, _, _ = model(inputs)
 
-            _, predicted = torch.max(outputs.data, 1)
-            total += labels.size(0)
-            correct += (predicted == labels).sum().item()
+                _, predicted = torch.max(outputs.data, 1)
+                total += labels.size(0)
+                correct += (predicted == labels).sum().item()
 
         accuracy = correct/total
 
@@ -1161,6 +1165,10 @@ if __name__ == "__main__":
                         help="RNG seed. Negative for random",
                         default=1, type=int)
 
+    parser.add_argument("--hyper-cache", dest="hyper_cache",
+                        help="Size of the cache for the output of the hypernetworks in evaluation (none if not given).",
+                        default=None, type=int)
+
     options = parser.parse_args()
 
     print('OPTIONS ', options)
@@ -0,0 +1,314 @@
+import torch
+from torch import nn
+
+import os, json
+import numpy as np
+
+import util
+
+"""
+Static inference form of a trained hyperlayer. Once the weights of an input-independent hyperlayer (like ParamASHLayer)
+are learned, the sparse weight matrix never changes, so it can be computed once and stored in compressed sparse row
+(CSR) format. The forward then consists of a single sparse-dense matrix multiplication.
+
+Create a FrozenLayer by calling freeze() on a hyperlayer. For deployment, FrozenLayer.quantize() produces an even
+smaller QuantizedLayer. Both can be written to disk with export_sparse(path) and read back with load_sparse(path).
+"""
+
+def csr(indices, values, size):
+    """
+    Converts a list of (row, column) index tuples and their values to CSR format. Duplicate index tuples are summed
+    (as they are in the product of a non-coalesced sparse matrix).
+
+    :param indices: A size (n, 2) LongTensor of (row, column) indices
+    :param values: A length-n vector of values
+    :param size: The size (height, width) of the matrix
+    :return: A triple (row pointers, column indices, values). The entries are sorted by row, and then by column.
+    """
+    height, width = (int(s) for s in size)
+
+    w = torch.sparse_coo_tensor(indices.t(), values, (height, width)).coalesce()
+    rows, cols = w.indices()
+
+    crow = torch.zeros(height + 1, dtype=torch.long, device=rows.device)
+    crow[1:] = torch.bincount(rows, minlength=height).cumsum(dim=0)
+
+    return crow, cols.contiguous(), w.values().contiguous()
+
+class FrozenLayer(nn.Module):
+    """
+    A fixed sparse linear transformation from a tensor of in_shape to a tensor of out_shape (plus an optional dense
+    bias).
+
+    The weight matrix is stored as three buffers (row pointers, column indices and values), so that it moves with
+    .cuda()/.to() and is stored in the state dict.
+    """
+
+    BUFFERS = ['crow', 'cols', 'values', 'bias']
+
+    def __init__(self, indices, values, size, in_shape, out_shape, bias=None):
+        """
+        :param indices: A size (n, 2) LongTensor of (row, column) indices into the flattened weight matrix
+        :param values: A length-n vector of values
+        :param size: The size (height, width) of the flattened weight matrix
+        :param in_shape: The shape of the input (without batch dimension)
+        :param out_shape: The shape of the output (without batch dimension)
+        :param bias: A tensor of out_shape, or None
+        """
+        super().__init__()
+
+        self.in_shape = tuple(in_shape)
+        self.out_shape = tuple(out_shape)
+        self.size = tuple(int(s) for s in size)
+
+        assert self.size == (util.prod(self.out_shape), util.prod(self.in_shape))
+
+        crow, cols, vals = csr(indices.detach(), values.detach(), self.size)
+
+        self.register_buffer('crow', crow)
+        self.register_buffer('cols', cols)
+        self.register_buffer('values', vals)
+        self.register_buffer('bias', None if bias is None else bias.detach().clone())
+
+    def weight(self):
+        """
+        :return: The weight matrix as a sparse CSR tensor (this does not copy the data)
+        """
+        return torch.sparse_csr_tensor(self.crow, self.cols, self.values, self.size)
+
+    def nnz(self):
+        return self.values.size(0)
+
+    def quantize(self, mode='int8', chunk=1024):
+        """
+        :param mode: 'int8' for linearly quantized values, 'codebook' for indices into a table of at most 256 values.
+        :param chunk: The number of rows dequantized at a time in the forward.
+        :return: A QuantizedLayer with the same weight matrix (up to quantization).
+        """
+        return QuantizedLayer(self, mode=mode, chunk=chunk)
+
+    def export_sparse(self, path):
+        export_sparse(self, path)
+
+    def forward(self, input):
+
+        b = input.size(0)
+        x_flat = input.reshape(b, -1)
+
+        y_flat = torch.mm(self.weight(), x_flat.t()).t()
+
+        y = y_flat.reshape((b,) + self.out_shape)
+
+        if self.bias is not None:
+            y = y + self.bias
+
+        return y
+
+def index_dtype(max):
+    """
+    The smallest integer type that can hold indices up to the given value (pytorch has no unsigned 16 or 32 bit types).
+    """
+    if max < 2 ** 15:
+        return torch.int16
+    if max < 2 ** 31:
+        return torch.int32
+    return torch.long
+
+def nearest(values, table):
+    """
+    For each value, finds the index of the nearest entry in a sorted table.
+
+    :param values: A vector of values
+    :param table: A sorted vector
+    :return: A LongTensor of the same size as values
+    """
+    if table.size(0) == 1:
+        return torch.zeros(values.size(), dtype=torch.long, device=values.device)
+
+    idx = torch.searchsorted(table, values).clamp(1, table.size(0) - 1)
+    left, right = table[idx - 1], table[idx]
+
+    return torch.where(values - left < right - values, idx - 1, idx)
+
+def codebook(values, size=256, iterations=16):
+    """
+    Computes a table of at most 'size' values that approximates the given values well, by 1D k-means. If there are no
+    more than 'size' distinct values (for instance for weight sharing layers), these are returned exactly.
+
+    :param values: A vector of values
+    :return: A sorted vector
+    """
+    unique = values.unique()
+    if unique.size(0) <= size:
+        return unique
+
+    # initialize at evenly spaced quantiles
+    sorted = values.sort()[0]
+    table = sorted[torch.linspace(0, sorted.size(0) - 1, size, device=values.device).long()]
+
+    for _ in range(iterations):
+        codes = nearest(values, table)
+
+        sums = torch.zeros(size, dtype=values.dtype, device=values.device).index_add_(0, codes, values)
+        counts = torch.bincount(codes, minlength=size)
+
+        table = torch.where(counts > 0, sums / counts.clamp(min=1).to(values.dtype), table)
+        table = table.sort()[0]
+
+    return table
+
+class QuantizedLayer(nn.Module):
+    """
+    Quantized version of a FrozenLayer, for deployment. Row pointers and column indices are stored in the smallest
+    integer type that fits, and the values either as int8 (with a single scale), or as uint8 indices into a table of at
+    most 256 values.
+
+    The forward dequantizes the values a chunk of rows at a time, so that memory use stays bounded.
+    """
+
+    BUFFERS = ['crow', 'cols', 'codes', 'scale', 'table', 'bias']
+
+    def __init__(self, frozen, mode='int8', chunk=1024):
+        super().__init__()
+
+        assert mode in ('int8', 'codebook')
+
+        self.in_shape = frozen.in_shape
+        self.out_shape = frozen.out_shape
+        self.size = frozen.size
+        self.mode = mode
+        self.chunk = chunk
+
+        height, width = self.size
+        values = frozen.values
+
+        self.register_buffer('crow', frozen.crow.to(index_dtype(values.size(0))))
+        self.register_buffer('cols', frozen.cols.to(index_dtype(width)))
+
+        if mode == 'int8':
+            scale = values.abs().max() / 127.0 if values.size(0) > 0 else torch.tensor(1.0)
+            scale = scale if scale > 0 else torch.ones_like(scale)
+
+            self.register_buffer('codes', (values / scale).round().clamp(-127, 127).to(torch.int8))
+            self.register_buffer('scale', scale.reshape(1))
+            self.register_buffer('table', None)
+        else:
+            table = codebook(values)
+
+            self.register_buffer('codes', nearest(values, table).to(torch.uint8))
+            self.register_buffer('scale', None)
+            self.register_buffer('table', table)
+
+        self.register_buffer('bias', frozen.bias)
+
+    def dequantize(self, fr, to):
+        """
+        :return: The values of entries fr to to (in CSR order) as floats.
+        """
+        codes = self.codes[fr:to]
+
+        if self.mode == 'int8':
+            return codes.float() * self.scale
+
+        return self.table[codes.long()]
+
+    def export_sparse(self, path):
+        export_sparse(self, path)
+
+    def forward(self, input):
+
+        b = input.size(0)
+        height, width = self.size
+
+        xt = input.reshape(b, -1).t()
+        yt = torch.zeros(height, b, dtype=xt.dtype, device=xt.device)
+
+        crow = self.crow.long()
+
+        for r0 in range(0, height, self.chunk):
+            r1 = min(r0 + self.chunk, height)
+            fr, to = int(crow[r0]), int(crow[r1])
+
+            if fr == to:
+                continue
+
+            # the (chunk-relative) row of each entry
+            counts = crow[r0+1:r1+1] - crow[r0:r1]
+            rows = torch.repeat_interleave(torch.arange(r1 - r0, device=xt.device), counts)
+
+            cols = self.cols[fr:to].long()
+            values = self.dequantize(fr, to)
+
+            yt[r0:r1].index_add_(0, rows, values[:, None] * xt[cols])
+
+        y = yt.t().reshape((b,) + self.out_shape)
+
+        if self.bias is not None:
+            y = y + self.bias
+
+        return y
+
+def export_sparse(layer, path):
+    """
+    Writes a FrozenLayer or QuantizedLayer to the directory 'path': one .npy file per buffer (row pointers, column
+    indices, values, bias, ...) and a file meta.json with the shapes.
+
+    Plain .npy files can be memory-mapped, so that a loaded layer shares its memory (through the page cache) with every
+    other process that loads the same files.
+
+    :param layer:
+    :param path: A directory (created if it does not exist)
+    """
+    util.makedirs(path)
+
+    meta = {
+        'type': 'quantized' if isinstance(layer, QuantizedLayer) else 'frozen',
+        'in_shape': list(layer.in_shape),
+        'out_shape': list(layer.out_shape),
+        'size': list(layer.size),
+        'mode': getattr(layer, 'mode', None),
+        'chunk': getattr(layer, 'chunk', None),
+        'buffers': []
+    }
+
+    for name, buffer in layer.named_buffers():
+        np.save(os.path.join(path, name + '.npy'), buffer.detach().cpu().numpy())
+        meta['buffers'].append(name)
+
+    with open(os.path.join(path, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+def load_sparse(path, mmap=True):
+    """
+    Loads a layer written by export_sparse().
+
+    :param path:
+    :param mmap: If true, the arrays are memory-mapped (copy-on-write) instead of read into memory. Loading is then
+        near-instant, and the data is only read from disk as it is used.
+    :return: A FrozenLayer or a QuantizedLayer (on the CPU)
+    """
+    with open(os.path.join(path, 'meta.json'), 'r') as file:
+        meta = json.load(file)
+
+    cls = QuantizedLayer if meta['type'] == 'quantized' else FrozenLayer
+
+    # bypass the constructor: the weights are already computed
+    layer = cls.__new__(cls)
+    nn.Module.__init__(layer)
+
+    layer.in_shape = tuple(meta['in_shape'])
+    layer.out_shape = tuple(meta['out_shape'])
+    layer.size = tuple(meta['size'])
+
+    if cls is QuantizedLayer:
+        layer.mode = meta['mode']
+        layer.chunk = meta['chunk']
+
+    for name in cls.BUFFERS:
+        if name in meta['buffers']:
+            array = np.load(os.path.join(path, name + '.npy'), mmap_mode='c' if mmap else None)
+            layer.register_buffer(name, torch.from_numpy(array))
+        else:
+            layer.register_buffer(name, None)
+
+    return layer
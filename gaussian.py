@@ -9,7 +9,7 @@ import torch.nn.functional as F
 
 
 from util import *
-import util
+import util, frozen
 
 import sys
 import time, random, logging
@@ -298,7 +298,119 @@ def sample_indices(batchsize, k, num, rng, use_cuda=False):
 
     return full_indices
 
-class HyperLayer(nn.Module):
+class HyperLayerMixin():
+    """
+    Helpers shared by the hyperlayers of all samplers (here, in globalsampling, and in the temp variants). Expects the
+    layer to be an nn.Module that sets self.use_cuda and self.constants, and, for the helpers that use them,
+    self.hyper_cache, self.workspace, and (for freeze()) self.in_shape.
+    """
+
+    def call_hyper(self, input, **kwargs):
+        """
+        Evaluates the hypernetwork, through the cache if there is one. The cache is only used when gradients are
+        disabled (as in evaluation under torch.no_grad()).
+        """
+        if self.hyper_cache is None or torch.is_grad_enabled():
+            return self.hyper(input, **kwargs)
+
+        return self.hyper_cache.lookup(self, input, **kwargs)
+
+    def constant(self, data, dtype=torch.float):
+        """
+        A tensor with the given data on the device of this layer. It is created only once, and registered as a
+        non-persistent buffer, so that it moves with the layer but isn't stored in the state dict. Use this for
+        constants that depend only on the shapes of the layer; for those that vary with the batch, use util.constant.
+        """
+        key = (data if isinstance(data, (tuple, range)) else tuple(data), dtype)
+
+        if key not in self.constants:
+            name = 'constant{}'.format(len(self.constants))
+            value = torch.tensor(list(data), dtype=dtype, device='cuda' if self.use_cuda else 'cpu')
+
+            self.register_buffer(name, value, persistent=False)
+            self.constants[key] = name
+
+        return getattr(self, self.constants[key])
+
+    def empty(self, name, size, dtype=torch.float, device='cpu'):
+        """
+        An uninitialized tensor for an intermediate result. If this layer has a workspace, the tensor is reused between
+        calls.
+        """
+        if self.workspace is None:
+            return torch.empty(size, dtype=dtype, device=device)
+
+        return self.workspace.get(name, size, dtype, device)
+
+    def long(self, name, x):
+        """
+        Converts x to a LongTensor (rounding toward zero, like x.long()). If this layer has a workspace, the result is
+        written to a reused buffer.
+        """
+        if self.workspace is None:
+            return x.long()
+
+        return self.workspace.get(name, x.size(), torch.long, x.device).copy_(x)
+
+    def bmult(self, width, height, num_indices, batchsize, use_cuda, out=None):
+
+        bmult = self.constant((int(height), int(width)), torch.long)
+        m = util.constant(range(batchsize), torch.long, 'cuda' if self.use_cuda else 'cpu')
+
+        bmult = bmult.unsqueeze(0).unsqueeze(0)
+        m = m.unsqueeze(1).unsqueeze(1)
+
+        bmult = bmult.expand(batchsize, num_indices, 2)
+        m = m.expand(batchsize, num_indices, 2)
+
+        return torch.mul(m, bmult, out=out)
+
+    def batch_indices(self, mindices, flat_size):
+        """
+        Offsets the matrix indices of each instance in the batch, so that together they describe a single
+        block-diagonal matrix.
+
+        :param mindices: A size (b, n, 2) LongTensor of matrix indices
+        :param flat_size: The size of a single matrix
+        :return: A size (2, b*n) LongTensor of indices, and the size of the block-diagonal matrix
+        """
+        b, n, _ = mindices.size()
+
+        bm = self.bmult(flat_size[1], flat_size[0], n, b, self.use_cuda,
+                        out=self.empty('bm', mindices.size(), torch.long, mindices.device))
+
+        return (mindices + bm).view(-1, 2).t(), flat_size * b
+
+    def freeze(self):
+        """
+        Computes the sparse weight matrix as it is used in evaluation (with the means rounded to the nearest integer
+        indices), and returns it as a static FrozenLayer, whose forward is a single sparse-dense product.
+
+        Only valid for hyperlayers whose hypernetwork does not depend on the input (like ParamASHLayer).
+
+        :return: A frozen.FrozenLayer
+        """
+        input = torch.zeros((1,) + tuple(self.in_shape), device='cuda' if self.use_cuda else 'cpu')
+
+        with torch.no_grad():
+            res = self.hyper_frozen(input)
+
+            means, values = res[0], res[2]
+            bias = res[3] if self.bias_type == Bias.DENSE else None
+
+            indices = means.round().long()
+            mindices, flat_size = flatten_indices_mat(indices, self.in_shape, self.out_size)
+
+        return frozen.FrozenLayer(mindices[0], values[0], flat_size, self.in_shape, self.out_size, bias)
+
+    def hyper_frozen(self, input):
+        """
+        The output of the hypernetwork that freeze() uses. Layers whose hypernetwork samples its output should
+        override this to return a deterministic one, so that freezing the same layer twice gives the same result.
+        """
+        return self.hyper(input)
+
+class HyperLayer(HyperLayerMixin, nn.Module):
     """
         Abstract class for the hyperlayer. Implement by defining a hypernetwork, and returning it from the hyper() method.
     """
@@ -319,11 +431,35 @@ class HyperLayer(nn.Module):
 
     def __init__(self,
                  in_rank, out_shape, additional=0, bias_type=Bias.DENSE, sparse_input=False,
-                 subsample=None, reinforce=False, relative_range=None, rr_additional=None):
+                 subsample=None, reinforce=False, relative_range=None, rr_additional=None, selection=None,
+                 shared_weight=False, hyper_cache=None, workspace=False,
+                 max_tuples_per_chunk=None, checkpoint=False, replay=False):
+        """
+        :param subsample: If not None, the proportion of the index tuples to learn over in each forward pass
+        :param selection: How to select the index tuples to learn over if subsample is set. None for uniform random
+            selection, 'topk' or 'proportional' to select by the magnitude of the gradient (see util.Importance).
+        :param shared_weight: If true, the hypernetwork is evaluated for the first instance in the batch only, and the
+            resulting sparse matrix is applied to the whole batch. Only valid if the hypernetwork does not depend on the
+            input.
+        :param hyper_cache: If not None, the size of an LRU cache for the output of the hypernetwork in evaluation
+            (see util.HyperCache).
+        :param workspace: If true, the buffers for intermediate results that don't need to be kept for the backward
+            (random samples, batch offsets) are reused between calls instead of allocated in every forward (see
+            util.Workspace).
+        :param max_tuples_per_chunk: If not None, batches that would require more than this many integer index tuples
+            are split into micro-batches, which are discretized and multiplied one at a time. This bounds the peak
+            memory use of the forward at the cost of some speed.
+        :param checkpoint: If true, the discretization and the sparse product are not stored for the backward, but
+            recomputed from the output of the hypernetwork (with the same random samples). This saves memory at the
+            cost of extra computation.
+        :param replay: If true, the sampled integer tuples are not kept for the backward of the sparse product. Instead,
+            the sampling is seeded, and the tuples are regenerated from the seed in the backward (see util.ReplayMult).
+        """
         super().__init__()
 
         self.reinforce = reinforce
         self.use_cuda = False
+        self.constants = {} # names of the constant buffers (see constant())
         self.in_rank = in_rank
         self.out_size = out_shape # without batch dimension
         self.additional = additional
@@ -335,24 +471,18 @@ class HyperLayer(nn.Module):
         self.bias_type = bias_type
         self.sparse_input = sparse_input
         self.subsample = subsample
+        self.importance = None if selection is None else util.Importance(selection)
+        self.shared_weight = shared_weight
+        self.hyper_cache = None if hyper_cache is None else util.HyperCache(hyper_cache)
+        self.workspace = util.Workspace() if workspace else None
+        self.max_tuples_per_chunk = max_tuples_per_chunk
+        self.checkpoint = checkpoint
+        self.replay = replay
 
         # create a tensor with all binary sequences of length 'rank' as rows
         lsts = [[int(b) for b in bools] for bools in itertools.product([True, False], repeat=self.weights_rank)]
         self.floor_mask = torch.ByteTensor(lsts)
 
-    def bmult(self, width, height, num_indices, batchsize, use_cuda):
-
-        bmult = torch.cuda.LongTensor([height, width]) if use_cuda else LongTensor([height, width])
-        m = torch.cuda.LongTensor(range(batchsize)) if use_cuda else LongTensor(range(batchsize))
-
-        bmult = bmult.unsqueeze(0).unsqueeze(0)
-        m = m.unsqueeze(1).unsqueeze(1)
-
-        bmult = bmult.expand(batchsize, num_indices, 2)
-        m = m.expand(batchsize, num_indices, 2)
-
-        return m * bmult
-
     def sigma_loss(self, input):
         """
         Possible regularization loss term: sigmoid(-log(mean sigma))
@@ -390,8 +520,7 @@ class HyperLayer(nn.Module):
         # Limits for each of the w_rank indices
         # and scales for the sigmas
         ws = list(output_size) + list(input_size)
-        s = torch.cuda.FloatTensor(ws) if self.use_cuda else FloatTensor(ws)
-        s = Variable(s.contiguous())
+        s = self.constant(ws)
 
         ss = s.unsqueeze(0).unsqueeze(0)
         sm = s - 1
@@ -412,7 +541,7 @@ class HyperLayer(nn.Module):
         return means, sigmas, values
 
 
-    def split_shared(self, res, input_size, output_size, values):
+    def split_shared(self, res, input_size, output_size, values, sample=True):
         """
         Splits res into means and sigmas, samples values according to multinomial parameters
         in res
@@ -421,6 +550,8 @@ class HyperLayer(nn.Module):
         :param input_size:
         :param output_size:
         :param gain:
+        :param sample: If false, each component gets its most likely value instead of a sampled one (and the
+            returned stochastic node is None).
         :return:
         """
 
@@ -435,8 +566,7 @@ class HyperLayer(nn.Module):
         # Limits for each of the w_rank indices
         # and scales for the sigmas
         ws = list(output_size) + list(input_size)
-        s = torch.cuda.FloatTensor(ws) if self.use_cuda else FloatTensor(ws)
-        s = Variable(s.contiguous())
+        s = self.constant(ws)
 
         ss = s.unsqueeze(0).unsqueeze(0)
         sm = s - 1
@@ -456,30 +586,27 @@ class HyperLayer(nn.Module):
 
         vweights = util.bsoftmax(vweights) + EPSILON
 
-        samples, snode = util.bmultinomial(vweights, num_samples=1)
+        if sample:
+            samples, snode = util.bmultinomial(vweights, num_samples=1)
+        else:
+            samples, snode = vweights.argmax(dim=2), None
 
         weights = values[samples.data.view(-1)].view(b, k)
 
         return means, sigmas, weights, snode
 
-    def discretize(self, means, sigmas, values, rng=None, additional=16, use_cuda=False, relative_range=None):
+    def generate_integer_tuples(self, means, rng=None, additional=16, use_cuda=False, relative_range=None, seed=None):
         """
-        Takes the output of a hypernetwork (real-valued indices and corresponding values) and turns it into a list of
-        integer indices, by "distributing" the values to the nearest neighboring integer indices.
-
-        NB: the returned ints is not a Variable (just a plain LongTensor). autograd of the real valued indices passes
-        through the values alone, not the integer indices used to instantiate the sparse matrix.
+        Generates the integer index-tuples for the given real-valued means: the neighboring integer tuples of each mean,
+        and, if rng is given, a number of sampled ones.
 
-        :param ind: A Variable containing a matrix of N by K, where K is the number of indices.
-        :param val: A Variable containing a vector of length N containing the values corresponding to the given indices
-        :return: a triple (ints, props, vals). ints is an N*2^K by K matrix representing the N*2^K integer index-tuples that can
-            be made by flooring or ceiling the indices in 'ind'. 'props' is a vector of length N*2^K, which indicates how
-            much of the original value each integer index-tuple receives (based on the distance to the real-valued
-            index-tuple). vals is vector of length N*2^K, containing the value of the corresponding real-valued index-tuple
-            (ie. vals just repeats each value in the input 'val' 2^K times).
+        :param means: A (batchsize, n, rank) tensor of real-valued index-tuples
+        :param seed: Seed for the sampled tuples. Calls with the same seed (and means) produce the same tuples.
+        :return: A (batchsize, n, w, rank) LongTensor, containing w integer index-tuples for each mean.
         """
 
         batchsize, n, rank = means.size()
+        gen = util.generator(seed, means.device)
 
         # ints is the same size as ind, but for every index-tuple in ind, we add an extra axis containing the 2^rank
         # integerized index-tuples we can make from that one real-valued index-tuple
@@ -487,15 +614,7 @@ class HyperLayer(nn.Module):
         t0 = time.time()
 
         if BATCH_NEIGHBORS:
-            fm = self.floor_mask.unsqueeze(0).unsqueeze(0).expand(batchsize, n, 2 ** rank, rank)
-
-            neighbor_ints = means.data.unsqueeze(2).expand(batchsize, n, 2 ** rank, rank).contiguous()
-
-
-            neighbor_ints[fm] = neighbor_ints[fm].floor()
-            neighbor_ints[~fm] = neighbor_ints[~fm].ceil()
-
-            neighbor_ints = neighbor_ints.long()
+            neighbor_ints = util.neighbors(means, self.floor_mask)
 
         else:
             neighbor_ints = LongTensor(batchsize, n, 2 ** rank, rank)
@@ -530,34 +649,34 @@ class HyperLayer(nn.Module):
 
                 ints = tup(ints_flat.view(-1), rng, use_cuda=False)
                 ints = ints.unsqueeze(0).unsqueeze(0).view(batchsize, n, 2 ** rank + additional, rank)
-                ints_fl = ints.float().cuda() if use_cuda else ints.float()
+                ints = ints.cuda() if use_cuda else ints
 
             else:
                 """
                 Sample uniformly from all possible index-tuples, with replacement
                 """
-                sampled_ints = torch.cuda.FloatTensor(batchsize, n, additional, rank) if use_cuda else FloatTensor(batchsize, n, additional, rank)
+                sampled_ints = self.empty('sampled_ints', (batchsize, n, additional, rank), device=means.device)
 
-                sampled_ints.uniform_()
+                sampled_ints.uniform_(generator=gen)
                 sampled_ints *= (1.0 - EPSILON)
 
-                rng = torch.cuda.FloatTensor(rng) if use_cuda else FloatTensor(rng)
+                rng = self.constant(rng)
                 rngxp = rng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(sampled_ints)
 
-                sampled_ints = torch.floor(sampled_ints * rngxp).long()
+                sampled_ints = self.long('sampled_ints_long', sampled_ints.mul_(rngxp).floor_())
 
 
                 if relative_range is not None:
                     """
                     Sample uniformly from a small range around the given index tuple
                     """
-                    rr_ints = torch.cuda.FloatTensor(batchsize, n, self.rr_additional, rank) if use_cuda else FloatTensor(batchsize, n, self.rr_additional, rank)
+                    rr_ints = self.empty('rr_ints', (batchsize, n, self.rr_additional, rank), device=means.device)
 
-                    rr_ints.uniform_()
+                    rr_ints.uniform_(generator=gen)
                     rr_ints *= (1.0 - EPSILON)
 
                     rngxp = rng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(rr_ints) # bounds of the tensor
-                    rrng = torch.cuda.FloatTensor(relative_range) if use_cuda else FloatTensor(relative_range) # bounds of the range from which to sample
+                    rrng = self.constant(relative_range) # bounds of the range from which to sample
                     rrng = rrng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(rr_ints)
 
                     mns_expand = means.round().unsqueeze(2).expand_as(rr_ints)
@@ -576,17 +695,52 @@ class HyperLayer(nn.Module):
                     # print('means', means.round().long())
                     # print('lower', lower)
 
-                    rr_ints = (rr_ints * rrng + lower).long()
+                    rr_ints = self.long('rr_ints_long', rr_ints.mul_(rrng).add_(lower.detach()))
 
                 samples = [neighbor_ints, sampled_ints, rr_ints] if relative_range is not None else [neighbor_ints, sampled_ints]
-                ints = torch.cat(samples, dim=2)
-                ints_fl = ints.float()
+                width = sum(sample.size(2) for sample in samples)
+
+                ints = torch.cat(samples, dim=2, out=self.empty('ints', (batchsize, n, width, rank), torch.long, means.device))
+
+        return ints
+
+    def discretize(self, means, sigmas, values, rng=None, additional=16, use_cuda=False, relative_range=None, seed=None, replay=False):
+        """
+        Takes the output of a hypernetwork (real-valued indices and corresponding values) and turns it into a list of
+        integer indices, by "distributing" the values to the nearest neighboring integer indices.
+
+        NB: the returned ints is not a Variable (just a plain LongTensor). autograd of the real valued indices passes
+        through the values alone, not the integer indices used to instantiate the sparse matrix.
+
+        :param ind: A Variable containing a matrix of N by K, where K is the number of indices.
+        :param val: A Variable containing a vector of length N containing the values corresponding to the given indices
+        :param replay: If true, the integer tuples are not kept for the backward of the densities, but regenerated
+            from the seed.
+        :return: a triple (ints, props, vals). ints is an N*2^K by K matrix representing the N*2^K integer index-tuples that can
+            be made by flooring or ceiling the indices in 'ind'. 'props' is a vector of length N*2^K, which indicates how
+            much of the original value each integer index-tuple receives (based on the distance to the real-valued
+            index-tuple). vals is vector of length N*2^K, containing the value of the corresponding real-valued index-tuple
+            (ie. vals just repeats each value in the input 'val' 2^K times).
+        """
+
+        batchsize, n, rank = means.size()
+
+        ints = self.generate_integer_tuples(means, rng=rng, additional=additional, use_cuda=use_cuda,
+                                            relative_range=relative_range, seed=seed)
+        ints_fl = ints.float()
 
         ints_fl = Variable(ints_fl)  # leaf node in the comp graph, gradients go through values
 
         t0 = time.time()
         # compute the proportion of the value each integer index tuple receives
-        props = densities(ints_fl, means, sigmas)
+        if replay:
+            def regenerate(means=means.detach()):
+                return self.generate_integer_tuples(means, rng=rng, additional=additional, use_cuda=use_cuda,
+                                                    relative_range=relative_range, seed=seed).float()
+
+            props = util.ReplayDensities.apply(ints_fl, regenerate, densities, means, sigmas)
+        else:
+            props = densities(ints_fl, means, sigmas)
         # props is batchsize x K x 2^rank+a, giving a weight to each neighboring or sampled integer-index-tuple
 
         # -- normalize the proportions of the neigh points and the
@@ -608,19 +762,22 @@ class HyperLayer(nn.Module):
 
         return ints, props, val
 
-    def forward(self, input, train=True):
+    def forward(self, input, seed=None, train=True):
 
         ### Compute and unpack output of hypernetwork
 
         t0 = time.time()
         bias = None
 
+        # with a shared weight, we need only one instance of the sparse matrix
+        hinput = input[:1] if self.shared_weight else input
+
         if self.bias_type == Bias.NONE:
-            means, sigmas, values = self.hyper(input)
+            means, sigmas, values = self.call_hyper(hinput)
         elif self.bias_type == Bias.DENSE:
-            means, sigmas, values, bias = self.hyper(input)
+            means, sigmas, values, bias = self.call_hyper(hinput)
         elif self.bias_type == Bias.SPARSE:
-            means, sigmas, values, bias_means, bias_sigmas, bias_values = self.hyper(input)
+            means, sigmas, values, bias_means, bias_sigmas, bias_values = self.call_hyper(hinput)
         else:
             raise Exception('bias type {} not recognized.'.format(self.bias_type))
 
@@ -628,9 +785,62 @@ class HyperLayer(nn.Module):
         if self.sparse_input:
             input = input.dense()
 
-        return self.forward_inner(input, means, sigmas, values, bias, train=train)
+        # the means to learn over are chosen once for the whole batch, before it is split into micro-batches
+        selected = self.select_means(means) if train and not self.reinforce and self.subsample is not None else None
+
+        if self.checkpoint and train and not self.reinforce and torch.is_grad_enabled():
+            return util.checkpoint(self.forward_inner, input, means, sigmas, values, bias, seed=seed,
+                                   selected=selected, train=train)
+
+        return self.forward_inner(input, means, sigmas, values, bias, seed=seed, selected=selected, train=train)
 
-    def forward_inner(self, input, means, sigmas, values, bias, train=True):
+    def select_means(self, means):
+        """
+        Chooses the means to learn over in subsample mode, and registers the choice with the importance estimate (if
+        any).
+
+        :return: A length-k boolean mask.
+        """
+        k = means.size(1)
+
+        if self.importance is None:
+            prop = self.constant((self.subsample,))
+
+            selected = None
+            while (selected is None) or (float(selected.sum()) < 1):
+                selected = torch.bernoulli(prop.expand(k)).bool()
+
+            return selected
+
+        # same expected number of components as the bernoulli selection, chosen by gradient magnitude
+        selected = self.importance.select(k, int(round(self.subsample * k)), device=means.device)
+        self.importance.track(means, selected)
+
+        return selected
+
+    def forward_inner(self, input, means, sigmas, values, bias, seed=None, selected=None, train=True):
+        """
+        :param selected: In subsample mode, the mask returned by select_means().
+        """
+
+        if self.max_tuples_per_chunk is not None and not self.shared_weight and not self.reinforce:
+            b, k, rank = means.size()
+
+            rr = self.rr_additional if self.relative_range is not None else 0
+            tuples = k * (2 ** rank + self.additional + rr) if train else k
+
+            bounds = util.chunk_bounds(b, tuples, self.max_tuples_per_chunk)
+
+            if len(bounds) > 1:
+                batched = bias is not None and bias.dim() > len(self.out_size)
+
+                # each micro-batch gets its own seed, so that they don't all sample the same tuples
+                seeds = util.chunk_seeds(seed, len(bounds))
+
+                return torch.cat([
+                    self.forward_inner(input[fr:to], means[fr:to], sigmas[fr:to], values[fr:to],
+                                       bias[fr:to] if batched else bias, seed=cs, selected=selected, train=train)
+                    for (fr, to), cs in zip(bounds, seeds)], dim=0)
 
         t0total = time.time()
 
@@ -648,26 +858,31 @@ class HyperLayer(nn.Module):
         # turn the real values into integers in a differentiable way
         t0 = time.time()
 
+        # If not None, a function that regenerates the integer tuples in the backward
+        replay = None
+        if train and self.replay and seed is None:
+            seed = util.draw_seed()
+
         if train:
             if not self.reinforce:
                 if self.subsample is None:
+                    if self.replay:
+                        def replay(means=means.detach()):
+                            b, _, r = means.size()
+                            return self.generate_integer_tuples(means, rng=rng, additional=self.additional,
+                                use_cuda=self.use_cuda, relative_range=self.relative_range, seed=seed).view(b, -1, r)
+
                     indices, props, values = self.discretize(means, sigmas, values, rng=rng, additional=self.additional,
-                    use_cuda=self.use_cuda, relative_range=self.relative_range)
+                    use_cuda=self.use_cuda, relative_range=self.relative_range, seed=seed, replay=self.replay)
 
                     values = values * props
                 else: # select a small proportion of the indices to learn over
 
                     b, k, r = means.size()
 
-                    prop = torch.cuda.FloatTensor([self.subsample]) if self.use_cuda else torch.FloatTensor([self.subsample])
-
-                    selection = None
-                    while (selection is None) or (float(selection.sum()) < 1):
-                        selection = torch.bernoulli(prop.expand(k)).byte()
-
-                    mselection = selection.unsqueeze(0).unsqueeze(2).expand_as(means)
-                    sselection = selection.unsqueeze(0).unsqueeze(2).expand_as(sigmas)
-                    vselection = selection.unsqueeze(0).expand_as(values)
+                    mselection = selected.unsqueeze(0).unsqueeze(2).expand_as(means)
+                    sselection = selected.unsqueeze(0).unsqueeze(2).expand_as(sigmas)
+                    vselection = selected.unsqueeze(0).expand_as(values)
 
                     means_in, means_out = means[mselection].view(b, -1, r), means[~ mselection].view(b, -1, r)
                     sigmas_in, sigmas_out = sigmas[sselection].view(b, -1, r), sigmas[~ sselection].view(b, -1, r)
@@ -676,7 +891,13 @@ class HyperLayer(nn.Module):
                     means_out = means_out.detach()
                     values_out = values_out.detach()
 
-                    indices_in, props, values_in = self.discretize(means_in, sigmas_in, values_in, rng=rng, additional=self.additional, use_cuda=self.use_cuda)
+                    if self.replay:
+                        def replay(means=means_in.detach()):
+                            ints = self.generate_integer_tuples(means, rng=rng, additional=self.additional,
+                                use_cuda=self.use_cuda, seed=seed).view(b, -1, r)
+                            return torch.cat([ints, means_out.round().long()], dim=1)
+
+                    indices_in, props, values_in = self.discretize(means_in, sigmas_in, values_in, rng=rng, additional=self.additional, use_cuda=self.use_cuda, seed=seed, replay=self.replay)
                     values_in = values_in * props
 
                     indices_out = means_out.data.round().long()
@@ -693,7 +914,7 @@ class HyperLayer(nn.Module):
                 # if the sampling puts the indices out of bounds, we just clip to the min and max values
                 indices[indices < 0] = 0
 
-                rngt = torch.tensor(data=rng, device='cuda' if self.use_cuda else 'cpu')
+                rngt = self.constant(rng, torch.long)
 
                 maxes = rngt.unsqueeze(0).unsqueeze(0).expand_as(means) - 1
                 indices[indices > maxes] = maxes[indices > maxes]
@@ -727,10 +948,6 @@ class HyperLayer(nn.Module):
         #    now, we'll do a slow, naive multiplication.
 
         x_flat = input.view(batchsize, -1)
-        ly = prod(self.out_size)
-
-        y_flat = torch.cuda.FloatTensor(batchsize, ly) if self.use_cuda else FloatTensor(batchsize, ly)
-        y_flat.fill_(0.0)
 
         sparsemult = util.sparsemult(self.use_cuda)
 
@@ -739,20 +956,34 @@ class HyperLayer(nn.Module):
         # Prevent segfault
         assert not util.contains_nan(values.data)
 
-        bm = self.bmult(flat_size[1], flat_size[0], mindices.size()[1], batchsize, self.use_cuda)
-        bfsize = Variable(flat_size * batchsize)
+        if not train and not self.shared_weight:
+            # Each instance has exactly k index tuples, so we can skip the sparse matrix and compute the product
+            # directly with a gather and a scatter-add
+            y_flat = util.gathermm(mindices, values, flat_size, x_flat)
+
+        elif self.shared_weight:
+            # A single sparse matrix, multiplied with the whole batch as a dense (in, b) matrix
+            sparsemm = util.sparsemm(self.use_cuda)
 
-        bfindices = mindices + bm
-        bfindices = bfindices.view(1, -1, 2).squeeze(0)
-        vindices = Variable(bfindices.t())
+            y_flat = sparsemm(mindices[0].t(), values.view(-1), flat_size, x_flat.t()).t()
+        else:
+            vindices, bfsize = self.batch_indices(mindices, flat_size)
 
-        bfvalues = values.view(1, -1).squeeze(0)
-        bfx = x_flat.view(1, -1).squeeze(0)
+            bfvalues = values.view(1, -1).squeeze(0)
+            bfx = x_flat.view(1, -1).squeeze(0)
 
-        # print(vindices.size(), bfvalues.size(), bfsize, bfx.size())
-        bfy = sparsemult(vindices, bfvalues, bfsize, bfx)
+            if replay is None:
+                bfy = sparsemult(vindices, bfvalues, bfsize, bfx)
+            else:
+                in_size = input.size()[1:]
 
-        y_flat = bfy.unsqueeze(0).view(batchsize, -1)
+                def regenerate():
+                    mindices, _ = flatten_indices_mat(replay(), in_size, self.out_size)
+                    return self.batch_indices(mindices, flat_size)[0]
+
+                bfy = util.ReplayMult.apply(vindices, regenerate, bfvalues, bfsize, bfx)
+
+            y_flat = bfy.unsqueeze(0).view(batchsize, -1)
 
         y_shape = [batchsize]
         y_shape.extend(self.out_size)
@@ -766,6 +997,12 @@ class HyperLayer(nn.Module):
             pass
 
         if self.reinforce and train:
+            if self.shared_weight:
+                # the sample is shared by the whole batch: expand it, so that the loss of each instance can be
+                # matched to the log-probability of the sample
+                dists = dists.expand(torch.Size([batchsize]) + dists.batch_shape[1:])
+                samples = samples.expand(batchsize, *samples.size()[1:])
+
             return y, dists, samples
         else:
             return y
@@ -797,11 +1034,16 @@ class ParamASHLayer(HyperLayer):
     """
 
     def __init__(self, in_shape, out_shape, k, additional=0, sigma_scale=0.2, fix_values=False,  has_bias=False,
-                 subsample=None, min_sigma=0.0, reinforce=False, relative_range=None, rr_additional=None):
+                 subsample=None, min_sigma=0.0, reinforce=False, relative_range=None, rr_additional=None, selection=None,
+                 shared_weight=False, hyper_cache=None, workspace=False,
+                 max_tuples_per_chunk=None, checkpoint=False, replay=False):
         super().__init__(in_rank=len(in_shape), additional=additional, out_shape=out_shape,
                          bias_type=Bias.DENSE if has_bias else Bias.NONE, subsample=subsample,
                          reinforce=reinforce, relative_range=relative_range,
-                         rr_additional=rr_additional)
+                         rr_additional=rr_additional, selection=selection, shared_weight=shared_weight,
+                         hyper_cache=hyper_cache, workspace=workspace,
+                         max_tuples_per_chunk=max_tuples_per_chunk, checkpoint=checkpoint,
+                         replay=replay)
 
         self.k = k
         self.in_shape = in_shape
@@ -872,9 +1114,11 @@ class WeightSharingASHLayer(HyperLayer):
         self.sources = Parameter(torch.randn(num_values))
         # self.sources = Variable(FloatTensor([-1.0, 1.0]))
 
-    def hyper(self, input):
+    def hyper(self, input, sample=True):
         """
         Evaluates hypernetwork.
+
+        :param sample: If false, each component takes its most likely value from the sources, instead of a sampled one.
         """
 
         batch_size = input.size()[0]
@@ -883,11 +1127,15 @@ class WeightSharingASHLayer(HyperLayer):
         rows, columns = self.params.size()
         res = self.params.unsqueeze(0).expand(batch_size, rows, columns)
 
-        means, sigmas, values, self.samples = self.split_shared(res, input.size()[1:], self.out_shape, self.sources)
+        means, sigmas, values, self.samples = self.split_shared(res, input.size()[1:], self.out_shape, self.sources,
+                                                                sample=sample)
         sigmas = sigmas * self.sigma_scale
 
         return means, sigmas, values
 
+    def hyper_frozen(self, input):
+        return self.hyper(input, sample=False)
+
     def call_reinforce(self, downstream_reward):
         b, = downstream_reward.size()
 
@@ -909,8 +1157,10 @@ class ImageCASHLayer(HyperLayer):
     """
     """
 
-    def __init__(self, in_shape, out_shape, k, additional=0, poolsize=4, subsample=None):
-        super().__init__(in_rank=len(in_shape), out_shape=out_shape, additional=additional, bias_type=Bias.DENSE, subsample=subsample)
+    def __init__(self, in_shape, out_shape, k, additional=0, poolsize=4, subsample=None, hyper_cache=None,
+                 checkpoint=False):
+        super().__init__(in_rank=len(in_shape), out_shape=out_shape, additional=additional, bias_type=Bias.DENSE, subsample=subsample,
+                         hyper_cache=hyper_cache, checkpoint=checkpoint)
 
         self.k = k
         self.in_shape = in_shape
@@ -981,7 +1231,8 @@ class CASHLayer(HyperLayer):
     """
     def __init__(self, in_shape, out_shape, k,
                  additional=0, poolsize=4, deconvs=2, ksize=2, sigma_scale=0.1, has_bias=True,
-                 has_channels=False, adaptive_bias=False, subsample=None, min_sigma=0.0, fix_values=False):
+                 has_channels=False, adaptive_bias=False, subsample=None, min_sigma=0.0, fix_values=False, selection=None,
+                 hyper_cache=None, checkpoint=False):
         """
         :param in_shape:
         :param out_shape:
@@ -992,7 +1243,8 @@ class CASHLayer(HyperLayer):
            that the input is not downsampled along that dimension.
         :param deconvs: How many deconv layers to use to generate the tuples from the hidden layer
         """
-        super().__init__(in_rank=len(in_shape), out_shape=out_shape, additional=additional, bias_type=Bias.DENSE if has_bias else Bias.NONE, subsample=subsample)
+        super().__init__(in_rank=len(in_shape), out_shape=out_shape, additional=additional, bias_type=Bias.DENSE if has_bias else Bias.NONE,
+                         subsample=subsample, selection=selection, hyper_cache=hyper_cache, checkpoint=checkpoint)
 
         class NoActivation(nn.Module):
             def forward(self, input):
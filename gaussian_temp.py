@@ -25,7 +25,7 @@ from enum import Enum
 
 from tqdm import trange
 
-from gaussian import Bias, fi_matrix, flatten_indices_mat, densities, tup, fi
+from gaussian import Bias, HyperLayerMixin, fi_matrix, flatten_indices_mat, densities, tup, fi
 
 # added to the sigmas to prevent NaN
 EPSILON = 10e-7
@@ -41,7 +41,7 @@ This can, for instance, be used to create a layer that has 3 incoming connection
 the connections to the input nodes beaing learned.
 """
 
-class HyperLayer(nn.Module):
+class HyperLayer(HyperLayerMixin, nn.Module):
     """
         Abstract class for the hyperlayer. Implement by defining a hypernetwork, and returning it from the hyper() method.
     """
@@ -61,7 +61,7 @@ class HyperLayer(nn.Module):
         self.floor_mask = self.floor_mask.cuda()
 
     def __init__(self, in_rank, out_size, temp_indices, learn_cols, gadditional=0, radditional=0, region=None,
-                 bias_type=Bias.DENSE, sparse_input=False, subsample=None):
+                 bias_type=Bias.DENSE, sparse_input=False, subsample=None, hyper_cache=None, checkpoint=False):
         """
 
         :param in_rank:
@@ -71,10 +71,16 @@ class HyperLayer(nn.Module):
         :param bias_type:
         :param sparse_input:
         :param subsample:
+        :param hyper_cache: If not None, the size of an LRU cache for the output of the hypernetwork in evaluation
+            (see util.HyperCache).
+        :param checkpoint: If true, the discretization and the sparse product are not stored for the backward, but
+            recomputed from the output of the hypernetwork (with the same random samples). This saves memory at the
+            cost of extra computation.
         """
         super().__init__()
 
         self.use_cuda = False
+        self.constants = {} # names of the constant buffers (see constant())
         self.in_rank = in_rank
         self.out_size = out_size # without batch dimension
         self.gadditional = gadditional
@@ -84,6 +90,8 @@ class HyperLayer(nn.Module):
         self.bias_type = bias_type
         self.sparse_input = sparse_input
         self.subsample = subsample
+        self.hyper_cache = None if hyper_cache is None else util.HyperCache(hyper_cache)
+        self.checkpoint = checkpoint
         self.learn_cols = learn_cols
 
         # create a tensor with all binary sequences of length 'out_rank' as rows
@@ -123,8 +131,7 @@ class HyperLayer(nn.Module):
         # Limits for each of the w_rank indices
         # and scales for the sigmas
         ws = list(size)
-        s = torch.cuda.FloatTensor(ws) if self.use_cuda else torch.FloatTensor(ws)
-        s = Variable(s.contiguous())
+        s = self.constant(ws)
 
         ss = s.unsqueeze(0).unsqueeze(0)
         sm = s - 1
@@ -221,7 +228,7 @@ class HyperLayer(nn.Module):
                 sampled_ints.uniform_()
                 sampled_ints *= (1.0 - EPSILON)
 
-                rng = torch.cuda.FloatTensor(rng) if use_cuda else torch.FloatTensor(rng)
+                rng = self.constant(rng)
                 rngxp = rng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(sampled_ints)
 
                 sampled_ints = torch.floor(sampled_ints * rngxp).long()
@@ -237,8 +244,7 @@ class HyperLayer(nn.Module):
                     rr_ints *= (1.0 - EPSILON)
 
                     rngxp = rng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(rr_ints) # bounds of the tensor
-                    rrng = torch.cuda.FloatTensor(relative_range) if use_cuda \
-                        else torch.FloatTensor(relative_range) # bounds of the range from which to sample
+                    rrng = self.constant(relative_range) # bounds of the range from which to sample
 
                     rrng = rrng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(rr_ints)
 
@@ -304,11 +310,11 @@ class HyperLayer(nn.Module):
         bias = None
 
         if self.bias_type == Bias.NONE:
-            means, sigmas, values = self.hyper(input, **kwargs)
+            means, sigmas, values = self.call_hyper(input, **kwargs)
         elif self.bias_type == Bias.DENSE:
-            means, sigmas, values, bias = self.hyper(input, **kwargs)
+            means, sigmas, values, bias = self.call_hyper(input, **kwargs)
         elif self.bias_type == Bias.SPARSE:
-            means, sigmas, values, bias_means, bias_sigmas, bias_values = self.hyper(input, **kwargs)
+            means, sigmas, values, bias_means, bias_sigmas, bias_values = self.call_hyper(input, **kwargs)
         else:
             raise Exception('bias type {} not recognized.'.format(self.bias_type))
 
@@ -317,6 +323,9 @@ class HyperLayer(nn.Module):
         if self.sparse_input:
             input = input.dense()
 
+        if self.checkpoint and torch.is_grad_enabled():
+            return util.checkpoint(self.forward_inner, input, means, sigmas, values, bias)
+
         return self.forward_inner(input, means, sigmas, values, bias)
 
     def forward_inner(self, input, means, sigmas, values, bias):
@@ -25,7 +25,7 @@ from enum import Enum
 
 from tqdm import trange
 
-from gaussian import Bias, fi_matrix, flatten_indices_mat, tup, fi
+from gaussian import Bias, HyperLayerMixin, fi_matrix, flatten_indices_mat, tup, fi
 
 # added to the sigmas to prevent NaN
 EPSILON = 10e-7
@@ -91,7 +91,7 @@ def densities(points, means, sigmas):
 
     return num
 
-class HyperLayer(nn.Module):
+class HyperLayer(HyperLayerMixin, nn.Module):
     """
         Abstract class for the hyperlayer. Implement by defining a hypernetwork, and returning it from the hyper() method.
     """
@@ -111,7 +111,7 @@ class HyperLayer(nn.Module):
         self.floor_mask = self.floor_mask.cuda()
 
     def __init__(self, in_rank, out_size, temp_indices, learn_cols, chunk_size, gadditional=0, radditional=0, region=None,
-                 bias_type=Bias.DENSE, sparse_input=False, subsample=None):
+                 bias_type=Bias.DENSE, sparse_input=False, subsample=None, checkpoint=False):
         """
 
         :param in_rank:
@@ -121,10 +121,14 @@ class HyperLayer(nn.Module):
         :param bias_type:
         :param sparse_input:
         :param subsample:
+        :param checkpoint: If true, the discretization and the sparse product are not stored for the backward, but
+            recomputed from the output of the hypernetwork (with the same random samples). This saves memory at the
+            cost of extra computation.
         """
         super().__init__()
 
         self.use_cuda = False
+        self.constants = {} # names of the constant buffers (see constant())
         self.in_rank = in_rank
         self.out_size = out_size # without batch dimension
         self.gadditional = gadditional
@@ -134,6 +138,7 @@ class HyperLayer(nn.Module):
         self.bias_type = bias_type
         self.sparse_input = sparse_input
         self.subsample = subsample
+        self.checkpoint = checkpoint
         self.learn_cols = learn_cols
         self.chunk_size = chunk_size
 
@@ -148,33 +153,6 @@ class HyperLayer(nn.Module):
 
         self.register_buffer('temp_indices', temp_indices)
 
-        self.register_buffer('primes', torch.tensor(
-        [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97]))
-
-    def duplicates(self, tuples):
-        """
-        Takes a list of tuples, and for each tuple that occurs mutiple times
-        marks all but one of the occurences (in the mask that is returned), across dim 2.
-
-        :param tuples: A size (batch, k, rank) tensor of integer tuples
-        :return: A size (batch, k) mask indicating the duplicates
-        """
-        b, k, l, r = tuples.size()
-
-        primes = self.primes[:r]
-        primes = primes[None, None, None, :].expand(b, k, l, r)
-        unique = ((tuples+1) ** primes).prod(dim=3)  # unique identifier for each tuple
-
-        sorted, sort_idx = torch.sort(unique, dim=2)
-        _, unsort_idx = torch.sort(sort_idx, dim=2) # get the idx required to reverse the sort
-
-        mask = sorted[:, :, 1:] == sorted[:, :, :-1]
-
-        zs = torch.zeros(b, k, 1, dtype=torch.uint8, device='cuda' if self.use_cuda else 'cpu')
-        mask = torch.cat([zs, mask], dim=2)
-
-        return torch.gather(mask, 2, unsort_idx)
-
     def split_out(self, res, size):
         """
         Utility function. res is a B x K x Wrank+2 tensor with range from
@@ -201,8 +179,7 @@ class HyperLayer(nn.Module):
         # Limits for each of the w_rank indices
         # and scales for the sigmas
         ws = list(size)
-        s = torch.cuda.FloatTensor(ws) if self.use_cuda else torch.FloatTensor(ws)
-        s = Variable(s.contiguous())
+        s = self.constant(ws)
 
         ss = s.unsqueeze(0).unsqueeze(0)
         sm = s - 1
@@ -248,14 +225,7 @@ class HyperLayer(nn.Module):
         """
         Generate nearby tuples
         """
-        fm = self.floor_mask[None, None, None, :].expand(b, k, c, 2 ** rank, rank)
-
-        neighbor_ints = means.data[:, :, :, None, :].expand(b, k, c, 2 ** rank, rank).contiguous()
-
-        neighbor_ints[fm] = neighbor_ints[fm].floor()
-        neighbor_ints[~fm] = neighbor_ints[~fm].ceil()
-
-        neighbor_ints = neighbor_ints.long()
+        neighbor_ints = util.neighbors(means, self.floor_mask)
 
         """
         Sample uniformly from all integer tuples
@@ -267,7 +237,7 @@ class HyperLayer(nn.Module):
         sampled_ints.uniform_()
         sampled_ints *= (1.0 - EPSILON)
 
-        rng = torch.cuda.FloatTensor(rng) if use_cuda else torch.FloatTensor(rng)
+        rng = self.constant(rng)
         rngxp = rng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(sampled_ints)
 
         sampled_ints = torch.floor(sampled_ints * rngxp).long()
@@ -282,8 +252,7 @@ class HyperLayer(nn.Module):
         rr_ints *= (1.0 - EPSILON)
 
         rngxp = rng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(rr_ints) # bounds of the tensor
-        rrng = torch.cuda.FloatTensor(relative_range) if use_cuda \
-            else torch.FloatTensor(relative_range) # bounds of the range from which to sample
+        rrng = self.constant(relative_range) # bounds of the range from which to sample
 
         rrng = rrng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(rr_ints)
 
@@ -331,6 +300,9 @@ class HyperLayer(nn.Module):
         if self.sparse_input:
             input = input.dense()
 
+        if self.checkpoint and torch.is_grad_enabled():
+            return util.checkpoint(self.forward_inner, input, means, sigmas, values, bias)
+
         return self.forward_inner(input, means, sigmas, values, bias)
 
     def forward_inner(self, input, means, sigmas, values, bias):
@@ -352,7 +324,7 @@ class HyperLayer(nn.Module):
         indfl = indices.float()
 
         # Mask for duplicate indices
-        dups = self.duplicates(indices)
+        dups = util.duplicates(indices, shape=subrange)
 
         props = densities(indfl, means, sigmas).clone()  # result has size (b, k, l, c), l = indices[2]
         props[dups, :] = 0
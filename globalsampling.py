@@ -74,31 +74,7 @@ def densities(points, means, sigmas):
 
     return num
 
-class HyperLayer(nn.Module):
-
-    def duplicates(self, tuples):
-        """
-        Takes a list of tuples, and for each tuple that occurs mutiple times
-        marks all but one of the occurences (in the mask that is returned).
-
-        :param tuples: A size (batch, k, rank) tensor of integer tuples
-        :return: A size (batch, k) mask indicating the duplicates
-        """
-        b, k, r = tuples.size()
-
-        primes = self.primes[:r]
-        primes = primes.unsqueeze(0).unsqueeze(0).expand(b, k, r)
-        unique = ((tuples+1) ** primes).prod(dim=2)  # unique identifier for each tuple
-
-        sorted, sort_idx = torch.sort(unique, dim=1)
-        _, unsort_idx = torch.sort(sort_idx, dim=1)
-
-        mask = sorted[:, 1:] == sorted[:, :-1]
-
-        zs = torch.zeros(b, 1, dtype=torch.uint8, device='cuda' if self.use_cuda else 'cpu')
-        mask = torch.cat([zs, mask], dim=1)
-
-        return torch.gather(mask, 1, unsort_idx)
+class HyperLayer(gaussian.HyperLayerMixin, nn.Module):
 
     """
         Abstract class for the hyperlayer. Implement by defining a hypernetwork, and returning it from the hyper() method.
@@ -118,10 +94,35 @@ class HyperLayer(nn.Module):
 
     def __init__(self,
                  in_rank, out_shape, additional=0, bias_type=Bias.DENSE, sparse_input=False,
-                 subsample=None, relative_range=None, rr_additional=None):
+                 subsample=None, relative_range=None, rr_additional=None, selection=None, shared_weight=False,
+                 hyper_cache=None, workspace=False,
+                 max_tuples_per_chunk=None, checkpoint=False, replay=False):
+        """
+        :param subsample: If not None, the number of means to learn over in each forward pass
+        :param selection: How to select the means to learn over if subsample is set and no mrange is given to
+            forward(). None for uniform random selection, 'topk' or 'proportional' to select by the magnitude of the
+            gradient (see util.Importance).
+        :param shared_weight: If true, the hypernetwork is evaluated for the first instance in the batch only, and the
+            resulting sparse matrix is applied to the whole batch. Only valid if the hypernetwork does not depend on the
+            input.
+        :param hyper_cache: If not None, the size of an LRU cache for the output of the hypernetwork in evaluation
+            (see util.HyperCache).
+        :param workspace: If true, the buffers for intermediate results that don't need to be kept for the backward
+            (random samples, batch offsets) are reused between calls instead of allocated in every forward (see
+            util.Workspace).
+        :param max_tuples_per_chunk: If not None, batches that would require more than this many integer index tuples
+            are split into micro-batches, which are discretized and multiplied one at a time. This bounds the peak
+            memory use of the forward at the cost of some speed.
+        :param checkpoint: If true, the discretization and the sparse product are not stored for the backward, but
+            recomputed from the output of the hypernetwork (with the same random samples). This saves memory at the
+            cost of extra computation.
+        :param replay: If true, the sampled integer tuples are not kept for the backward of the sparse product. Instead,
+            the sampling is seeded, and the tuples are regenerated from the seed in the backward (see util.ReplayMult).
+        """
         super().__init__()
 
         self.use_cuda = False
+        self.constants = {} # names of the constant buffers (see constant())
         self.in_rank = in_rank
         self.out_size = out_shape # without batch dimension
         self.gadditional = additional
@@ -134,27 +135,18 @@ class HyperLayer(nn.Module):
         self.bias_type = bias_type
         self.sparse_input = sparse_input
         self.subsample = subsample
+        self.importance = None if selection is None else util.Importance(selection)
+        self.shared_weight = shared_weight
+        self.hyper_cache = None if hyper_cache is None else util.HyperCache(hyper_cache)
+        self.workspace = util.Workspace() if workspace else None
+        self.max_tuples_per_chunk = max_tuples_per_chunk
+        self.checkpoint = checkpoint
+        self.replay = replay
 
         # create a tensor with all binary sequences of length 'rank' as rows
         lsts = [[int(b) for b in bools] for bools in itertools.product([True, False], repeat=self.weights_rank)]
         self.register_buffer('floor_mask', torch.ByteTensor(lsts))
 
-        self.register_buffer('primes', torch.tensor(
-        [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97]))
-
-    def bmult(self, width, height, num_indices, batchsize, use_cuda):
-
-        bmult = torch.cuda.LongTensor([height, width]) if use_cuda else LongTensor([height, width])
-        m = torch.cuda.LongTensor(range(batchsize)) if use_cuda else LongTensor(range(batchsize))
-
-        bmult = bmult.unsqueeze(0).unsqueeze(0)
-        m = m.unsqueeze(1).unsqueeze(1)
-
-        bmult = bmult.expand(batchsize, num_indices, 2)
-        m = m.expand(batchsize, num_indices, 2)
-
-        return m * bmult
-
     def split_out(self, res, input_size, output_size):
         """
         Utility function. res is a B x K x Wrank+2 tensor with range from
@@ -179,8 +171,7 @@ class HyperLayer(nn.Module):
         # Limits for each of the w_rank indices
         # and scales for the sigmas
         ws = list(output_size) + list(input_size)
-        s = torch.cuda.FloatTensor(ws) if self.use_cuda else FloatTensor(ws)
-        s = Variable(s.contiguous())
+        s = self.constant(ws)
 
         ss = s.unsqueeze(0).unsqueeze(0)
         sm = s - 1
@@ -223,8 +214,7 @@ class HyperLayer(nn.Module):
         # Limits for each of the w_rank indices
         # and scales for the sigmas
         ws = list(output_size) + list(input_size)
-        s = torch.cuda.FloatTensor(ws) if self.use_cuda else FloatTensor(ws)
-        s = Variable(s.contiguous())
+        s = self.constant(ws)
 
         ss = s.unsqueeze(0).unsqueeze(0)
         sm = s - 1
@@ -252,37 +242,27 @@ class HyperLayer(nn.Module):
 
     def generate_integer_tuples(self, means, rng=None, use_cuda=False, relative_range=None, seed=None):
 
-        if seed is not None:
-            torch.manual_seed(seed)
+        gen = util.generator(seed, means.device)
 
         batchsize, n, rank = means.size()
 
         """
         Generate the neighboring integers
         """
-        fm = self.floor_mask.unsqueeze(0).unsqueeze(0).expand(batchsize, n, 2 ** rank, rank)
-
-        neighbor_ints = means.data.unsqueeze(2).expand(batchsize, n, 2 ** rank, rank).contiguous()
-
-        neighbor_ints[fm] = neighbor_ints[fm].floor()
-        neighbor_ints[~fm] = neighbor_ints[~fm].ceil()
-
-        neighbor_ints = neighbor_ints.long()
+        neighbor_ints = util.neighbors(means, self.floor_mask)
 
         """
         Sample uniformly from a small range around the given index tuple
         """
-        rr_ints = torch.cuda.FloatTensor(batchsize, n, self.radditional, rank) if use_cuda \
-            else FloatTensor(batchsize, n, self.radditional, rank)
+        rr_ints = self.empty('rr_ints', (batchsize, n, self.radditional, rank), device=means.device)
 
-        rr_ints.uniform_()
+        rr_ints.uniform_(generator=gen)
         rr_ints *= (1.0 - EPSILON)
 
-        rng = torch.cuda.FloatTensor(rng) if use_cuda else FloatTensor(rng)
+        rng = self.constant(rng)
 
         rngxp = rng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(rr_ints)  # bounds of the tensor
-        rrng = torch.cuda.FloatTensor(self.region) if use_cuda else FloatTensor(
-            self.region)  # bounds of the range from which to sample
+        rrng = self.constant(self.region)  # bounds of the range from which to sample
         rrng = rrng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(rr_ints)
 
         mns_expand = means.round().unsqueeze(2).expand_as(rr_ints)
@@ -298,21 +278,24 @@ class HyperLayer(nn.Module):
         idxs = upper > rngxp
         lower[idxs] = rngxp[idxs] - rrng[idxs]
 
-        rr_ints = (rr_ints * rrng + lower).long()
+        rr_ints = self.long('rr_ints_long', rr_ints.mul_(rrng).add_(lower.detach()))
 
         """
         Sample uniformly from all possible index-tuples, with replacement
         """
-        sampled_ints = torch.cuda.FloatTensor(batchsize, n, self.gadditional, rank) if use_cuda else FloatTensor(batchsize, n, self.gadditional, rank)
+        sampled_ints = self.empty('sampled_ints', (batchsize, n, self.gadditional, rank), device=means.device)
 
-        sampled_ints.uniform_()
+        sampled_ints.uniform_(generator=gen)
         sampled_ints *= (1.0 - EPSILON)
 
         rngxp = rng.unsqueeze(0).unsqueeze(0).unsqueeze(0).expand_as(sampled_ints)
 
-        sampled_ints = torch.floor(sampled_ints * rngxp).long()
+        sampled_ints = self.long('sampled_ints_long', sampled_ints.mul_(rngxp).floor_())
+
+        samples = [neighbor_ints, sampled_ints, rr_ints]
+        width = sum(sample.size(2) for sample in samples)
 
-        ints = torch.cat([neighbor_ints, sampled_ints, rr_ints], dim=2)
+        ints = torch.cat(samples, dim=2, out=self.empty('ints', (batchsize, n, width, rank), torch.long, means.device))
 
         return ints.view(batchsize, -1, rank)
 
@@ -323,12 +306,15 @@ class HyperLayer(nn.Module):
         t0 = time.time()
         bias = None
 
+        # with a shared weight, we need only one instance of the sparse matrix
+        hinput = input[:1] if self.shared_weight else input
+
         if self.bias_type == Bias.NONE:
-            means, sigmas, values = self.hyper(input)
+            means, sigmas, values = self.call_hyper(hinput)
         elif self.bias_type == Bias.DENSE:
-            means, sigmas, values, bias = self.hyper(input)
+            means, sigmas, values, bias = self.call_hyper(hinput)
         elif self.bias_type == Bias.SPARSE:
-            means, sigmas, values, bias_means, bias_sigmas, bias_values = self.hyper(input)
+            means, sigmas, values, bias_means, bias_sigmas, bias_values = self.call_hyper(hinput)
         else:
             raise Exception('bias type {} not recognized.'.format(self.bias_type))
 
@@ -337,9 +323,64 @@ class HyperLayer(nn.Module):
         if self.sparse_input:
             input = input.dense()
 
-        return self.forward_inner(input, means, sigmas, values, bias, mrange=mrange, seed=seed, train=train)
+        # the means to learn over are chosen once for the whole batch, before it is split into micro-batches
+        ids = self.select_means(means, mrange) if train and self.subsample is not None else None
+
+        if self.checkpoint and train and torch.is_grad_enabled():
+            return util.checkpoint(self.forward_inner, input, means, sigmas, values, bias, seed=seed, ids=ids,
+                                   train=train)
+
+        return self.forward_inner(input, means, sigmas, values, bias, seed=seed, ids=ids, train=train)
 
-    def forward_inner(self, input, means, sigmas, values, bias, mrange=None, seed=None, train=True):
+    def select_means(self, means, mrange=None):
+        """
+        Chooses the means to learn over in subsample mode, and registers the choice with the importance estimate (if
+        any).
+
+        :param mrange: If not None, a pair (from, to): the means in this range are chosen.
+        :return: A length-k boolean mask.
+        """
+        nm = means.size(1)
+
+        if mrange is not None:
+            fr, to = mrange
+            sample = range(fr, to)
+        elif self.importance is None:
+            sample = random.sample(range(nm), self.subsample) # the means we will learn for
+        else:
+            ids = self.importance.select(nm, self.subsample, device=means.device)
+            self.importance.track(means, ids)
+
+            return ids
+
+        ids = torch.zeros((nm,), dtype=torch.bool, device='cuda' if self.use_cuda else 'cpu')
+        ids[list(sample)] = 1
+
+        return ids
+
+    def forward_inner(self, input, means, sigmas, values, bias, seed=None, ids=None, train=True):
+        """
+        :param ids: In subsample mode, the mask returned by select_means().
+        """
+
+        if self.max_tuples_per_chunk is not None and not self.shared_weight:
+            b, n, rank = means.size()
+
+            # in training, the densities of all sampled tuples are computed under all means
+            tuples = n * (2 ** rank + self.gadditional + self.radditional) * n if train else n
+
+            bounds = util.chunk_bounds(b, tuples, self.max_tuples_per_chunk)
+
+            if len(bounds) > 1:
+                batched = bias is not None and bias.dim() > len(self.out_size)
+
+                # each micro-batch gets its own seed, so that they don't all sample the same tuples
+                seeds = util.chunk_seeds(seed, len(bounds))
+
+                return torch.cat([
+                    self.forward_inner(input[fr:to], means[fr:to], sigmas[fr:to], values[fr:to],
+                                       bias[fr:to] if batched else bias, seed=cs, ids=ids, train=train)
+                    for (fr, to), cs in zip(bounds, seeds)], dim=0)
 
         t0total = time.time()
 
@@ -353,19 +394,34 @@ class HyperLayer(nn.Module):
         # turn the real values into integers in a differentiable way
         t0 = time.time()
 
+        # If not None, a function that regenerates the integer tuples in the backward
+        replay = None
+
         if train:
+            if self.replay and seed is None:
+                seed = util.draw_seed()
+
             if self.subsample is None:
-                indices = self.generate_integer_tuples(means, rng=rng, use_cuda=self.use_cuda, relative_range=self.region)
+                indices = self.generate_integer_tuples(means, rng=rng, use_cuda=self.use_cuda, relative_range=self.region, seed=seed)
                 indfl = indices.float()
 
                 # Mask for duplicate indices
-                dups = self.duplicates(indices)
+                dups = util.duplicates(indices, shape=rng)
 
-                props = densities(indfl, means, sigmas).clone() # result has size (b, indices.size(1), means.size(1))
+                if self.replay:
+                    def replay(means=means.detach()):
+                        return self.generate_integer_tuples(means, rng=rng, relative_range=self.region, seed=seed)
+
+                    # the densities don't keep the float tuples for the backward either
+                    props = util.ReplayDensities.apply(indfl, lambda : replay().float(), densities, means, sigmas)
+                else:
+                    props = densities(indfl, means, sigmas) # result has size (b, indices.size(1), means.size(1))
+
+                props = props.clone()
                 props[dups] = 0
                 props = props / props.sum(dim=1, keepdim=True)
 
-                values = values.unsqueeze(1).expand(batchsize, indices.size(1), means.size(1))
+                values = values.unsqueeze(1).expand(means.size(0), indices.size(1), means.size(1))
 
                 values = props * values
                 values = values.sum(dim=2)
@@ -373,12 +429,6 @@ class HyperLayer(nn.Module):
             else:
                 # For large matrices we need to subsample the means we backpropagate for
                 b, nm, rank = means.size()
-                fr, to = mrange
-
-                # sample = random.sample(range(nm), self.subsample) # the means we will learn for
-                sample = range(fr, to)
-                ids = torch.zeros((nm,), dtype=torch.uint8, device='cuda' if self.use_cuda else 'cpu')
-                ids[sample] = 1
 
                 means_in, means_out = means[:, ids, :], means[:, ~ids, :]
                 sigmas_in, sigmas_out = sigmas[:, ids, :], sigmas[:, ~ids, :]
@@ -393,13 +443,21 @@ class HyperLayer(nn.Module):
                 indices = self.generate_integer_tuples(means, rng=rng, use_cuda=self.use_cuda, relative_range=self.region, seed=seed)
                 indfl = indices.float()
 
-                dups = self.duplicates(indices)
+                dups = util.duplicates(indices, shape=rng)
 
-                props = densities(indfl, means_in, sigmas_in) # result has size (b, indices.size(1), means.size(1))
-                props[dups] == 0
+                if self.replay:
+                    def replay_in(means=means.detach()):
+                        return self.generate_integer_tuples(means, rng=rng, relative_range=self.region, seed=seed)
+
+                    props = util.ReplayDensities.apply(indfl, lambda : replay_in().float(), densities, means_in, sigmas_in)
+                else:
+                    props = densities(indfl, means_in, sigmas_in) # result has size (b, indices.size(1), means.size(1))
+
+                props = props.clone()
+                props[dups] = 0
                 props = props / props.sum(dim=1, keepdim=True)
 
-                values_in = values_in.unsqueeze(1).expand(batchsize, indices.size(1), means_in.size(1))
+                values_in = values_in.unsqueeze(1).expand(b, indices.size(1), means_in.size(1))
 
                 values_in = props * values_in
                 values_in = values_in.sum(dim=2)
@@ -411,6 +469,10 @@ class HyperLayer(nn.Module):
 
                 indices = torch.cat([indices, indices_out], dim=1)
                 values = torch.cat([values_in, values_out], dim=1)
+
+                if self.replay:
+                    def replay():
+                        return torch.cat([replay_in(), means_out.round().long()], dim=1)
         else: # not train, just use the nearest indices
             indices = means.round().long()
 
@@ -429,20 +491,34 @@ class HyperLayer(nn.Module):
         # Prevent segfault
         assert not util.contains_nan(values.data)
 
-        bm = self.bmult(flat_size[1], flat_size[0], mindices.size()[1], batchsize, self.use_cuda)
-        bfsize = Variable(flat_size * batchsize)
+        if not train and not self.shared_weight:
+            # Each instance has exactly k index tuples, so we can skip the sparse matrix and compute the product
+            # directly with a gather and a scatter-add
+            y_flat = util.gathermm(mindices, values, flat_size, x_flat)
+
+        elif self.shared_weight:
+            # A single sparse matrix, multiplied with the whole batch as a dense (in, b) matrix
+            sparsemm = util.sparsemm(self.use_cuda)
+
+            y_flat = sparsemm(mindices[0].t(), values.view(-1), flat_size, x_flat.t()).t()
+        else:
+            vindices, bfsize = self.batch_indices(mindices, flat_size)
+
+            bfvalues = values.view(1, -1).squeeze(0)
+            bfx = x_flat.view(1, -1).squeeze(0)
 
-        bfindices = mindices + bm
-        bfindices = bfindices.view(1, -1, 2).squeeze(0)
-        vindices = Variable(bfindices.t())
+            if replay is None:
+                bfy = sparsemult(vindices, bfvalues, bfsize, bfx)
+            else:
+                in_size = input.size()[1:]
 
-        bfvalues = values.view(1, -1).squeeze(0)
-        bfx = x_flat.view(1, -1).squeeze(0)
+                def regenerate():
+                    mindices, _ = gaussian.flatten_indices_mat(replay(), in_size, self.out_size)
+                    return self.batch_indices(mindices, flat_size)[0]
 
-        # print(vindices.size(), bfvalues.size(), bfsize, bfx.size())
-        bfy = sparsemult(vindices, bfvalues, bfsize, bfx)
+                bfy = util.ReplayMult.apply(vindices, regenerate, bfvalues, bfsize, bfx)
 
-        y_flat = bfy.unsqueeze(0).view(batchsize, -1)
+            y_flat = bfy.unsqueeze(0).view(batchsize, -1)
 
         y_shape = [batchsize]
         y_shape.extend(self.out_size)
@@ -457,6 +533,124 @@ class HyperLayer(nn.Module):
 
         return y
 
+    def forward_chunked(self, input, loss_fn, chunk_size, seed=None):
+        """
+        Subsampled training step. Computes the gradient of loss_fn(y) by learning over chunk_size means at a time (the
+        other means are fixed to their nearest integer tuples), and accumulating the gradients of all chunks.
+
+        Unlike calling forward() with an mrange for every chunk, the hypernetwork, the integer tuples, the duplicate
+        mask and the matrix indices are computed only once per step. The graph is cut at the output of the
+        hypernetwork, so that only one chunk's intermediate values are held in memory at a time. The accumulated
+        gradients are passed through the hypernetwork in a single backward at the end.
+
+        NB: This method calls backward() itself. Call optimizer.step() afterwards.
+
+        :param input:
+        :param loss_fn: Function from the output of the layer to a scalar loss.
+        :param chunk_size: The number of means to learn over per chunk.
+        :param seed: Optional seed for the sampling of the integer tuples.
+        :return: The mean of the chunk losses (detached), so that it is on the same scale as the loss of a single
+            forward. The gradients are the sum over the chunks, as they would be for a forward(mrange=...) and a
+            backward per chunk.
+        """
+
+        bias = None
+
+        hinput = input[:1] if self.shared_weight else input
+
+        if self.bias_type == Bias.NONE:
+            means, sigmas, values = self.hyper(hinput)
+        elif self.bias_type == Bias.DENSE:
+            means, sigmas, values, bias = self.hyper(hinput)
+        else:
+            raise Exception('bias type {} not supported for chunked training.'.format(self.bias_type))
+
+        if self.sparse_input:
+            input = input.dense()
+
+        # -- cut the graph: the chunks backpropagate to these leaves
+        outputs = [means, sigmas, values, input] + ([] if bias is None else [bias])
+        leaves = [o.detach().requires_grad_(o.requires_grad) for o in outputs]
+
+        means, sigmas, values, input = leaves[:4]
+        bias = None if bias is None else leaves[4]
+
+        rng = tuple(self.out_size) + tuple(input.size()[1:])
+        batchsize = input.size()[0]
+        b, nm, rank = means.size()
+
+        ### Compute everything that is shared between chunks
+
+        indices = self.generate_integer_tuples(means, rng=rng, use_cuda=self.use_cuda, relative_range=self.region, seed=seed)
+        indfl = indices.float()
+
+        dups = util.duplicates(indices, shape=rng)
+
+        indices_out = means.data.round().long()
+
+        mindices, flat_size = gaussian.flatten_indices_mat(indices, input.size()[1:], self.out_size)
+        mindices_out, _ = gaussian.flatten_indices_mat(indices_out, input.size()[1:], self.out_size)
+
+        # all index tuples in a batch instance get the same offset, so we can select from these per chunk
+        # (b is 1 for a shared weight, so there are no offsets)
+        bfindices = mindices + self.bmult(flat_size[1], flat_size[0], mindices.size(1), b, self.use_cuda)
+        bfindices_out = mindices_out + self.bmult(flat_size[1], flat_size[0], nm, b, self.use_cuda)
+
+        bfsize = flat_size * b
+        x_flat = input.contiguous().view(batchsize, -1)
+
+        y_shape = [batchsize]
+        y_shape.extend(self.out_size)
+
+        sparsemult = util.sparsemult(self.use_cuda)
+        sparsemm = util.sparsemm(self.use_cuda)
+
+        total, chunks = 0.0, 0
+        for fr in range(0, nm, chunk_size):
+            to = min(fr + chunk_size, nm)
+
+            ids = torch.zeros((nm,), dtype=torch.bool, device='cuda' if self.use_cuda else 'cpu')
+            ids[fr:to] = 1
+
+            props = densities(indfl, means[:, ids, :], sigmas[:, ids, :]).clone() # (b, indices.size(1), to - fr)
+            props[dups] = 0
+            props = props / props.sum(dim=1, keepdim=True)
+
+            values_in = props * values[:, None, ids]
+            values_in = values_in.sum(dim=2)
+
+            # The other means are not learned over in this chunk
+            values_out = values[:, ~ids].detach()
+
+            bfvalues = torch.cat([values_in, values_out], dim=1).view(-1)
+            cindices = torch.cat([bfindices, bfindices_out[:, ~ids, :]], dim=1).view(-1, 2)
+
+            # Prevent segfault
+            assert not util.contains_nan(bfvalues.data)
+
+            if self.shared_weight:
+                y = sparsemm(cindices.t(), bfvalues, bfsize, x_flat.t()).t()
+            else:
+                y = sparsemult(cindices.t(), bfvalues, bfsize, x_flat.view(-1))
+
+            y = y.contiguous().view(y_shape)
+
+            if bias is not None:
+                y = y + bias
+
+            loss = loss_fn(y)
+            loss.backward()
+
+            total += loss.detach()
+            chunks += 1
+
+        # pass the accumulated gradients through the hypernetwork (and whatever produced the input)
+        pairs = [(o, l.grad) for o, l in zip(outputs, leaves) if o.requires_grad and l.grad is not None]
+        if len(pairs) > 0:
+            torch.autograd.backward([o for o, _ in pairs], [g for _, g in pairs])
+
+        return total / chunks
+
     def forward_sample(self, input):
         """
         Samples a single sparse matrix, and computes a transformation with that in a non-differentiable manner.
@@ -482,11 +676,16 @@ class ParamASHLayer(HyperLayer):
     """
 
     def __init__(self, in_shape, out_shape, k, additional=0, sigma_scale=0.2, fix_values=False,  has_bias=False,
-                min_sigma=0.0, relative_range=None, rr_additional=None, subsample=None):
+                min_sigma=0.0, relative_range=None, rr_additional=None, subsample=None, selection=None,
+                shared_weight=False, hyper_cache=None, workspace=False,
+                max_tuples_per_chunk=None, checkpoint=False, replay=False):
         super().__init__(in_rank=len(in_shape), additional=additional, out_shape=out_shape,
                          bias_type=Bias.DENSE if has_bias else Bias.NONE,
                         relative_range=relative_range,
-                         rr_additional=rr_additional, subsample=subsample)
+                         rr_additional=rr_additional, subsample=subsample, selection=selection,
+                         shared_weight=shared_weight, hyper_cache=hyper_cache, workspace=workspace,
+                         max_tuples_per_chunk=max_tuples_per_chunk, checkpoint=checkpoint,
+                         replay=replay)
 
         self.k = k
         self.in_shape = in_shape
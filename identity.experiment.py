@@ -59,7 +59,8 @@ def go(arg):
                 sigma_scale=arg.sigma_scale,
                 has_bias=False, fix_values=arg.fix_values, min_sigma=arg.min_sigma,
                 relative_range=(arg.rr, arg.rr),
-                rr_additional=arg.ca, subsample=arg.subsample)
+                rr_additional=arg.ca, subsample=arg.subsample, selection=arg.selection,
+                shared_weight=arg.shared_weight)
         else:
             model = gaussian.ParamASHLayer(
                 SHAPE, SHAPE, k=arg.size, additional=additional,
@@ -67,7 +68,7 @@ def go(arg):
                 has_bias=False, fix_values=arg.fix_values, min_sigma=arg.min_sigma,
                 reinforce=arg.reinforce,
                 relative_range=None if arg.rr is None else (arg.rr, arg.rr),
-                rr_additional=arg.ca)
+                rr_additional=arg.ca, shared_weight=arg.shared_weight)
 
         if arg.cuda:
             model.cuda()
@@ -96,16 +97,16 @@ def go(arg):
                 else:
                     optimizer.zero_grad()
 
-                    # multiple forward/backward passes, accumulate gradient
-                    seed = (torch.rand(1) * 100000).long().item()
-                    for fr in range(0, arg.size, arg.subsample):
-                        to = min(fr + arg.subsample, arg.size)
-
-                        y = model(x, mrange=(fr, to), seed=seed)
+                    if arg.selection is None:
+                        # one forward pass, gradient accumulated over chunks of the means
+                        loss = model.forward_chunked(x, lambda y : F.mse_loss(y, x), arg.subsample)
+                    else:
+                        # learn only over the means selected by gradient magnitude
+                        y = model(x)
 
                         loss = F.mse_loss(y, x)
-
                         loss.backward()
+
                     optimizer.step()
 
             else:
@@ -231,6 +232,11 @@ if __name__ == "__main__":
                         help="The number of index tuples to subsample for learning",
                         default=None, type=int)
 
+    parser.add_argument("--selection",
+                        dest="selection",
+                        help="How to select the means to learn over in subsample mode (topk, proportional). If not set, all means are learned over in chunks.",
+                        default=None, type=str)
+
     parser.add_argument("-d", "--dot-every",
                         dest="dot_every",
                         help="A dot in the graph for every x iterations",
@@ -264,6 +270,10 @@ if __name__ == "__main__":
                         help="Use the global sampling approach.",
                         action="store_true")
 
+    parser.add_argument("-W", "--shared-weight", dest="shared_weight",
+                        help="Sample a single sparse matrix per batch, instead of one per instance.",
+                        action="store_true")
+
     options = parser.parse_args()
 
     print('OPTIONS ', options)
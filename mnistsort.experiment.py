@@ -138,7 +138,8 @@ def go(arg):
         util.makedirs('./mnist-sort/{}'.format( r))
 
         model = sort.SortLayer(arg.size, additional=arg.additional, sigma_scale=arg.sigma_scale,
-                               sigma_floor=arg.min_sigma, certainty=arg.certainty)
+                               sigma_floor=arg.min_sigma, certainty=arg.certainty, backend=arg.backend,
+                               checkpoint='all' if arg.loss == 'plain' else False)
 
         # bottom = nn.Linear(28*28, 32, bias=False)
         # bottom.weight.retain_grad()
@@ -205,13 +206,18 @@ def go(arg):
             x = x.view(arg.batch, arg.size, -1)
             t = t.view(arg.batch, arg.size, -1)
 
-            ys, ts, keys = model(x, keys=keys, target=t)
+            if arg.loss == 'plain':
+                # the plain loss only needs the output: the intermediates are not kept (see SortLayer.forward_lean()),
+                # and the reverse-sorted target is not computed
+                y, keys = model(x, keys=keys, intermediates=False)
+            else:
+                ys, ts, keys = model(x, keys=keys, target=t)
 
             if arg.loss == 'plain':
                 # just compare the output to the target
-                # loss = F.mse_loss(ys[-1], t) # compute the loss
-                # loss = F.binary_cross_entropy(ys[-1].clamp(0, 1), t.clamp(0, 1))
-                loss = util.xent(ys[-1], t).mean()
+                # loss = F.mse_loss(y, t) # compute the loss
+                # loss = F.binary_cross_entropy(y.clamp(0, 1), t.clamp(0, 1))
+                loss = util.xent(y, t).mean()
             elif arg.loss == 'means':
                 # compare the output to the back-sorted target at each step
                 loss = 0.0
@@ -541,6 +547,10 @@ if __name__ == "__main__":
                         help="Whether to backwards-sort the target to provide a loss at every step. (plain, means, separate)",
                         default='plain', type=str)
 
+    parser.add_argument("-K", "--backend",
+                        dest="backend",
+                        help="How the splits apply their permutations (sparse, gather).",
+                        default='sparse', type=str)
 
     options = parser.parse_args()
 
@@ -141,7 +141,8 @@ def go(arg):
         util.makedirs('./multisort/{}'.format( r))
 
         model = sort.SortLayer(arg.size, additional=arg.additional, sigma_scale=arg.sigma_scale,
-                               sigma_floor=arg.min_sigma, certainty=arg.certainty)
+                               sigma_floor=arg.min_sigma, certainty=arg.certainty, backend=arg.backend,
+                               checkpoint='all' if arg.loss == 'plain' else False)
 
         # - channel sizes
         c1, c2, c3 = 16, 64, 128
@@ -204,11 +205,16 @@ def go(arg):
             x = x.view(arg.batch, arg.size, -1)
             t = t.view(arg.batch, arg.size, -1)
 
-            ys, ts, keys = model(x, keys=keys, target=t)
+            if arg.loss == 'plain':
+                # the plain loss only needs the output: the intermediates are not kept (see SortLayer.forward_lean()),
+                # and the reverse-sorted target is not computed
+                y, keys = model(x, keys=keys, intermediates=False)
+            else:
+                ys, ts, keys = model(x, keys=keys, target=t)
 
             if arg.loss == 'plain':
                 # just compare the output to the target
-                loss = util.xent(ys[-1], t).mean()
+                loss = util.xent(y, t).mean()
             elif arg.loss == 'means':
                 # compare the output to the back-sorted target at each step
                 loss = 0.0
@@ -517,6 +523,10 @@ if __name__ == "__main__":
                         help="Whether to backwards-sort the target to provide a loss at every step.",
                         default="separate", type=str)
 
+    parser.add_argument("-K", "--backend",
+                        dest="backend",
+                        help="How the splits apply their permutations (sparse, gather).",
+                        default='sparse', type=str)
 
     options = parser.parse_args()
 
@@ -20,7 +20,13 @@ class Split(nn.Module):
     the matrix and so on.
 
     """
-    def __init__(self, size, depth, additional=1, sigma_scale=0.1, sigma_floor=0.0):
+    def __init__(self, size, depth, additional=1, sigma_scale=0.1, sigma_floor=0.0, checkpoint=False, backend='sparse'):
+        """
+        :param checkpoint: If true, the sampled permutations and the sparse products are not stored for the backward,
+            but recomputed (with the same random samples) from the input, the keys and the offset.
+        :param backend: 'sparse' to apply the sampled permutations as a sparse matrix (util.batchmm), 'gather' to apply
+            them one by one as a gather or scatter (util.MixPerm). The latter is faster for wide inputs.
+        """
         super().__init__()
 
         template = torch.LongTensor(range(size)).unsqueeze(1).expand(size, 2)
@@ -31,42 +37,22 @@ class Split(nn.Module):
         self.sigma_scale = sigma_scale
         self.sigma_floor = sigma_floor
         self.additional = additional
+        self.checkpoint = checkpoint
 
-    def duplicates(self, tuples):
-        """
-        Takes a list of tuples, and for each tuple that occurs mutiple times
-        marks all but one of the occurences (in the mask that is returned).
-
-        :param tuples: A size (batch, k, rank) tensor of integer tuples
-        :return: A size (batch, k) mask indicating the duplicates
-        """
-        b, k, r = tuples.size()
-
-        # unique = ((tuples.float() + 1) ** primes).prod(dim=2)  # unique identifier for each tuple
-        unique = util.unique(tuples.view(b*k, r)).squeeze().view(b, k)
-
-        sorted, sort_idx = torch.sort(unique, dim=1)
-        _, unsort_idx = torch.sort(sort_idx, dim=1)
-
-        mask = sorted[:, 1:] == sorted[:, :-1]
-        # mask = mask.view(b, k - 1)
-
-        zs = torch.zeros(b, 1, dtype=torch.uint8, device='cuda' if tuples.is_cuda else 'cpu')
-        mask = torch.cat([zs, mask], dim=1)
-
-        return torch.gather(mask, 1, unsort_idx)
+        assert backend in ('sparse', 'gather')
+        self.backend = backend
 
     def generate_integer_tuples(self, offset, additional=16):
 
         b, s = offset.size()
 
-        choices = offset.round().byte()[:, None, :]
+        choices = offset.round().bool()[:, None, :]
 
         if additional > 0:
             sampled = util.sample_offsets(b, additional, s, self.depth, cuda=offset.is_cuda)
             # sampled = ~ choices
 
-            choices = torch.cat([choices, sampled], dim=1).byte()
+            choices = torch.cat([choices, sampled], dim=1).bool()
 
         return self.generate(choices, offset)
 
@@ -85,7 +71,7 @@ class Split(nn.Module):
         indices = util.split(choices, self.depth)
 
         if n > 1:
-            dups = self.duplicates(indices)
+            dups = util.duplicates(indices)
 
             probs = probs.clone()
             probs[dups] = 0.0
@@ -94,47 +80,102 @@ class Split(nn.Module):
 
         return indices, probs
 
-    def forward(self, input, keys, offset, train=True, reverse=False, verbose=False):
+    def sample(self, offset, train=True):
+        """
+        Samples the half-permutations for the given offset.
+
+        :return: A pair (indices, probs) of size (b, n, s) tensors: for each of n sampled permutations, the position
+            each element moves to, and the weight of the permutation.
+        """
+        indices, probs = self.generate_integer_tuples(offset, self.additional if train else 0)
 
-        if train:
-            indices, probs = self.generate_integer_tuples(offset, self.additional)
-        else:
-            indices, probs = self.generate_integer_tuples(offset, 0)
+        return indices.detach(), probs
+
+    def forward(self, input, keys, offset, train=True, reverse=False, verbose=False, sample=None):
+        """
+        :param keys: The keys, which are permuted along with the input. May be None if only the input is needed.
+        :param sample: The result of a call to sample(). If given, this is used instead of sampling new permutations
+            from the offset. In particular, passing the sample of an earlier call with reverse=True applies the
+            transpose of the matrix of that call.
+        """
+
+        if self.checkpoint and torch.is_grad_enabled():
+            return util.checkpoint(self.forward_inner, input, keys, offset, train=train, reverse=reverse, verbose=verbose,
+                                   sample=sample)
+
+        return self.forward_inner(input, keys, offset, train=train, reverse=reverse, verbose=verbose, sample=sample)
+
+    def forward_inner(self, input, keys, offset, train=True, reverse=False, verbose=False, sample=None):
+
+        indices, probs = self.sample(offset, train) if sample is None else sample
 
         if verbose:
             print(indices[0, 0])
 
-        indices = indices.detach()
         b, n, s = indices.size()
 
-        template = self.template[None, None, :, :].expand(b, n, s, 2).contiguous()
-        if not reverse: # normal half-permutation
-            template[:, :, :, 0] = indices
-        else: # reverse the permutation
-            template[:, :, :, 1] = indices
-        indices = template
+        # permute the payload and the keys together
+        z = input.size(2)
+        both = input if keys is None else torch.cat([input, keys[:, :, None]], dim=2)
+
+        if self.backend == 'gather':
+            both = util.MixPerm.apply(indices, probs, both, not reverse)
+        else:
+            template = self.template[None, None, :s, :].expand(b, n, s, 2).contiguous()
+            if not reverse: # normal half-permutation
+                template[:, :, :, 0] = indices
+            else: # reverse the permutation
+                template[:, :, :, 1] = indices
+            indices = template
 
-        indices = indices.contiguous().view(b, -1, 2)
-        probs = probs.contiguous().view(b, -1)
+            indices = indices.contiguous().view(b, -1, 2)
+            probs = probs.contiguous().view(b, -1)
 
-        output   = util.batchmm(indices, probs, (s, s), input)
+            both = util.batchmm(indices, probs, (s, s), both)
 
-        keys_out = util.batchmm(indices, probs, (s, s), keys[:, :, None]).squeeze()
+        if keys is None:
+            return both, None
 
-        return output, keys_out
+        return both[:, :, :z], both[:, :, z]
 
 class SortLayer(nn.Module):
     """
 
     """
-    def __init__(self, size, additional=0, sigma_scale=0.1, sigma_floor=0.0, certainty=10.0):
+    def __init__(self, size, additional=0, sigma_scale=0.1, sigma_floor=0.0, certainty=10.0, checkpoint=False,
+                 backend='sparse', topk=None, compose=False, prune=0.0):
+        """
+        :param checkpoint: If true, the splits recompute their intermediate values in the backward instead of storing
+            them (see Split). If 'all', the same holds, except in forward(..., intermediates=False), where the levels
+            are checkpointed in segments, so that only the inputs of the segments are kept (see forward_lean()).
+        :param backend: How the splits apply their permutations (see Split).
+        :param topk: If not None, only the smallest 'topk' elements are sorted (see forward_topk()).
+        :param compose: If true, the permutations of all levels are composed into a single sparse matrix, which is
+            applied to the input once (see forward_composed()).
+        :param prune: In compose mode, entries of the composed matrix with a weight of at most this value are dropped.
+        """
         super().__init__()
 
-        mdepth = int(np.log2(size))
+        # inputs are padded to the next power of two
+        mdepth = int(np.ceil(np.log2(size)))
+        size = 2 ** mdepth
+
+        self.size = size
+        self.topk = topk
+        self.compose = compose
+        self.prune = prune
+        self.checkpoint = checkpoint
+
+        assert topk is None or not compose, 'The top-k and compose modes cannot be combined.'
 
+        # In top-k mode, each level splits a batch of single buckets, so all splits are depth 0
         self.layers = nn.ModuleList()
         for d in range(mdepth):
-            self.layers.append(Split(size, d, additional, sigma_scale, sigma_floor))
+            split = Split(size, d, additional, sigma_scale, sigma_floor, checkpoint=bool(checkpoint), backend=backend) \
+                if topk is None else \
+                Split(size // 2**d, 0, additional, sigma_scale, sigma_floor, checkpoint=bool(checkpoint), backend=backend)
+
+            self.layers.append(split)
 
         # self.certainty = nn.Parameter(torch.tensor([certainty]))
         self.register_buffer('certainty', torch.tensor([certainty]))
@@ -145,11 +186,93 @@ class SortLayer(nn.Module):
         #     nn.Sigmoid()
         # )
 
-    def forward(self, x, keys, target=None, train=True, verbose=False):
+    def pad(self, x, keys, target=None, lengths=None):
+        """
+        Pads a batch of inputs to the size of this layer. Rows beyond the length of an instance are padding: their
+        payload is set to zero, and they are given keys larger than all real keys in the batch, so that they are
+        sorted to the end.
+
+        The padding keys are finite and distinct (rather than +inf), so that the pivots and offsets stay well
+        defined, and each bucket is still split evenly.
+
+        :return: The padded x, keys and target, and a size (b, size) mask that is True for the real rows.
+        """
+        b, l = keys.size()
+        p = self.size
+
+        assert l <= p, 'Input of length {} is too long for a sort layer of size {}.'.format(l, p)
+
+        if lengths is None:
+            lengths = torch.full((b,), l, dtype=torch.long, device=keys.device)
+
+        mask = torch.arange(p, device=keys.device)[None, :] < lengths[:, None]
+
+        real = keys.detach()[mask[:, :l]]
+        top = real.max() if real.numel() > 0 else keys.new_zeros(())
+        fill = top + 1.0 + torch.arange(p, dtype=keys.dtype, device=keys.device)[None, :].expand(b, p)
+
+        keys = torch.where(mask, F.pad(keys, (0, p - l)), fill)
+        x = F.pad(x, (0, 0, 0, p - l)).masked_fill(~ mask[:, :, None], 0.0)
+
+        if target is not None:
+            target = F.pad(target, (0, 0, 0, p - l)).masked_fill(~ mask[:, :, None], 0.0)
+
+        return x, keys, target, mask
+
+    def pivots(self, keys, d):
+        """
+        :return: For each key, the median of its bucket at depth d
+        """
+        b, s = keys.size()
+
+        buckets = keys[:, :, None].view(b, 2**d, -1)
+
+        pivots = buckets.view(b*2**d, -1)
+        pivots = median(pivots, keepdim=True)
+        pivots = pivots.view(b, 2 ** d, -1).expand_as(buckets)
+
+        return pivots.contiguous().view(b, -1).expand_as(keys)
+
+    def forward(self, x, keys, target=None, train=True, verbose=False, lengths=None, intermediates=True):
+        """
+        :param x: A size (b, s, z) batch of inputs
+        :param keys: A size (b, s) batch of keys to sort the inputs by
+        :param target: Optional target of the same size as x, which is sorted in reverse through the same permutations.
+        :param lengths: Optional (b,) LongTensor with the length of each instance, for batches of sequences of
+            different lengths (see pad()). Inputs shorter than the size of the layer are padded in any case.
+        :param intermediates: If false, the intermediate inputs and targets are not returned. Use this, with
+            checkpoint='all', if the loss only needs the output (see forward_lean()).
+        :return: The sorted inputs and keys. If a target is given, all intermediate inputs and reverse-sorted targets
+            are returned as well.
+        """
+
+        if lengths is not None or keys.size(1) < self.size:
+            x, keys, target, mask = self.pad(x, keys, target, lengths)
+            result = self.forward(x, keys, target, train=train, verbose=verbose, intermediates=intermediates)
+
+            # report the padding keys as +inf
+            keys = result[-1].masked_fill(~ mask, float('inf'))
+
+            return result[:-1] + (keys,)
+
+        if self.topk is not None:
+            return self.forward_topk(x, keys, target, train=train)
+
+        if not train and not verbose:
+            result = self.forward_hard(x, keys, target)
+
+            if result is not None:
+                return result
+
+        if self.compose:
+            return self.forward_composed(x, keys, target, train=train)
+
+        if not intermediates:
+            return self.forward_lean(x, keys, target, train=train)
 
         xs = [x]
         targets = [target]
-        offsets = []
+        samples = []
 
         b, s, z = x.size()
         b, s = keys.size()
@@ -158,14 +281,8 @@ class SortLayer(nn.Module):
 
         for d, split in enumerate(self.layers):
 
-            buckets = keys[:, :, None].view(b, 2**d, -1)
-
             # compute pivots
-            pivots = buckets.view(b*2**d, -1)
-            pivots = median(pivots, keepdim=True)
-            pivots = pivots.view(b, 2 ** d, -1).expand_as(buckets)
-
-            pivots = pivots.contiguous().view(b, -1).expand_as(keys)
+            pivots = self.pivots(keys, d)
 
             # compute offsets by comparing values to pivots
             if train:
@@ -175,10 +292,12 @@ class SortLayer(nn.Module):
                 offset = (keys > pivots).float()
 
             # offset = offset.round() # DEBUG
-            offsets.append(offset)
 
+            # keep the sampled permutations, so that the reverse pass can apply their transpose
+            sample = split.sample(offset, train) if target is not None else None
+            samples.append(sample)
 
-            x, keys = split(x, keys, offset, train=train, verbose=verbose)
+            x, keys = split(x, keys, offset, train=train, verbose=verbose, sample=sample)
             xs.append(x)
 
             if verbose:
@@ -187,8 +306,8 @@ class SortLayer(nn.Module):
 
 
         if target is not None:
-            for split, offset in zip(self.layers[::-1], offsets[::-1]):
-                t, _ = split(t, keys, offset, train=train, reverse=True)
+            for split, sample in zip(self.layers[::-1], samples[::-1]):
+                t, _ = split(t, None, None, train=train, reverse=True, sample=sample)
                 targets.insert(0, t)
 
         if target is None:
@@ -196,12 +315,298 @@ class SortLayer(nn.Module):
 
         return xs, targets, keys
 
+    def forward_topk(self, x, keys, target=None, train=True):
+        """
+        Partial sort: the smallest self.topk elements are moved to the top of the output, in order. At each level, only
+        the buckets that start before position topk are split: the others can no longer contain any of the smallest
+        elements, so they are passed through untouched. The number of rows that are split per level drops from the
+        full size to at most topk plus one bucket.
+
+        The arguments and return values are the same as those of forward(). Only the first topk rows of the output
+        are sorted.
+        """
+        b, s, z = x.size()
+
+        xs = [x]
+        targets = [target]
+        samples = []
+
+        for split in self.layers:
+            bsize = split.size
+
+            # the number of buckets that may contain top-k elements
+            a = min((self.topk + bsize - 1) // bsize, s // bsize)
+            active = a * bsize
+
+            # split each active bucket as a separate instance
+            xa = x[:, :active].reshape(b * a, bsize, z)
+            ka = keys[:, :active].reshape(b * a, bsize)
+
+            pivots = self.pivots(ka, 0)
+            if train:
+                offset = F.sigmoid((ka - pivots) * self.certainty)
+            else:
+                offset = (ka > pivots).float()
+
+            sample = split.sample(offset, train) if target is not None else None
+            samples.append(sample)
+
+            xa, ka = split(xa, ka, offset, train=train, sample=sample)
+
+            x = torch.cat([xa.reshape(b, active, z), x[:, active:]], dim=1)
+            keys = torch.cat([ka.reshape(b, active), keys[:, active:]], dim=1)
+
+            xs.append(x)
+
+        if target is None:
+            return x, keys
+
+        t = target
+        for split, sample in zip(self.layers[::-1], samples[::-1]):
+            bsize = split.size
+            active = sample[0].size(0) // b * bsize
+
+            ta = t[:, :active].reshape(sample[0].size(0), bsize, -1)
+            ta, _ = split(ta, None, None, train=train, reverse=True, sample=sample)
+
+            t = torch.cat([ta.reshape(b, active, -1), t[:, active:]], dim=1)
+            targets.insert(0, t)
+
+        return xs, targets, keys
+
+    def forward_lean(self, x, keys, target=None, train=True):
+        """
+        The same computation as forward(), but the output of each level replaces its input, and only the two ends are
+        returned.
+
+        On its own, this only saves the memory of the returned lists: autograd still keeps what each level needs for
+        the backward. With checkpoint='all', the levels are divided into segments of about sqrt(depth) levels, each of
+        which is run under its own checkpoint. Only the inputs of the segments are kept, and the backward recomputes
+        one segment at a time, so the memory kept for the backward, and its peak during the backward, grow with the
+        square root of the depth rather than linearly. The cost is one extra forward pass in the backward.
+
+        If a target is given, the sampled permutations of all levels are kept for the reverse pass (these are
+        (b, n, s) tensors, without the payload), and the reverse pass is checkpointed per segment in the same way.
+
+        :return: The same as forward_composed(): if a target is given, xs contains only the input and the output, and
+            targets only the reverse-sorted target and the target.
+        """
+        depth = len(self.layers)
+        keep = target is not None
+
+        if self.checkpoint == 'all' and torch.is_grad_enabled():
+            segments = util.chunk_bounds(depth, 1, int(np.ceil(np.sqrt(depth))))
+
+            y, samples = x, []
+            for fr, to in segments:
+                y, keys, seg = util.checkpoint(self.levels, y, keys, fr, to, train=train, keep_samples=keep)
+                samples.extend(seg)
+
+            t = target
+            if keep:
+                for fr, to in segments[::-1]:
+                    t = util.checkpoint(self.unlevels, t, samples[fr:to], fr, to, train=train)
+        else:
+            y, keys, samples = self.levels(x, keys, 0, depth, train=train, keep_samples=keep)
+            t = self.unlevels(target, samples, 0, depth, train=train) if keep else None
+
+        if target is None:
+            return y, keys
+
+        return [x, y], [t, target], keys
+
+    def levels(self, x, keys, fr, to, train=True, keep_samples=False):
+        """
+        Applies levels fr to to (exclusive) to the input and the keys, without keeping the intermediate results.
+
+        :param keep_samples: If true, the sampled permutations of these levels are returned, so that their reverse can
+            be applied to a target (see unlevels()).
+        :return: The sorted input, the sorted keys and a list of the sampled permutations (empty if keep_samples is
+            false)
+        """
+        samples = []
+
+        for d in range(fr, to):
+            split = self.layers[d]
+
+            pivots = self.pivots(keys, d)
+            if train:
+                offset = F.sigmoid((keys - pivots) * self.certainty)
+            else:
+                offset = (keys > pivots).float()
+
+            # under a checkpoint of the whole segment, checkpointing the individual splits would only add recomputation
+            apply = split.forward_inner if self.checkpoint == 'all' else split
+
+            sample = split.sample(offset, train) if keep_samples else None
+            if keep_samples:
+                samples.append(sample)
+
+            x, keys = apply(x, keys, offset, train=train, sample=sample)
+
+        return x, keys, samples
+
+    def unlevels(self, t, samples, fr, to, train=True):
+        """
+        Applies the reverse of levels fr to to (exclusive) to a target, using the sampled permutations returned by
+        levels().
+        """
+        for split, sample in zip(self.layers[fr:to][::-1], samples[::-1]):
+            apply = split.forward_inner if self.checkpoint == 'all' else split
+            t, _ = apply(t, None, None, train=train, reverse=True, sample=sample)
+
+        return t
+
+    def forward_composed(self, x, keys, target=None, train=True):
+        """
+        Instead of applying each level to the full input, the sampled permutations of all levels are composed into one
+        sparse (s, s) mixing matrix per instance, which is then applied to the input (and, transposed, to the target)
+        once. Only the keys are permuted level by level, to compute the pivots.
+
+        This is cheaper than the level-by-level path if the input is wide, and the composed matrix stays sparse: with
+        one sample per level it is a permutation, but with additional samples the number of entries per column can
+        grow with each level. Entries with a weight of at most self.prune are dropped after each level to limit
+        this (the columns of the pruned matrix no longer sum to exactly one).
+
+        :return: The same as forward(), except that the intermediate inputs and targets are never computed: xs
+            contains only the input and the output, and targets only the reverse-sorted target and the target.
+        """
+        b, s, z = x.size()
+        dv = 'cuda' if x.is_cuda else 'cpu'
+
+        # the composed matrix, as the nonzero entries of a block-diagonal (b*s, b*s) matrix (starting at the identity)
+        rows = torch.arange(b * s, device=x.device)
+        cols = rows
+        values = torch.ones(b * s, dtype=x.dtype, device=x.device)
+
+        for d, split in enumerate(self.layers):
+
+            pivots = self.pivots(keys, d)
+            if train:
+                offset = F.sigmoid((keys - pivots) * self.certainty)
+            else:
+                offset = (keys > pivots).float()
+
+            sample = split.sample(offset, train)
+
+            keys, _ = split(keys[:, :, None], None, None, train=train, sample=sample)
+            keys = keys[:, :, 0]
+
+            rows, cols, values = compose(sample, rows, cols, values, prune=self.prune)
+
+        size = util.constant((b * s, b * s), torch.long, dv)
+        sm = util.sparsemm(x.is_cuda)
+
+        y = sm(torch.stack([rows, cols], dim=0), values, size, x.reshape(b * s, z)).view(b, s, z)
+
+        if target is None:
+            return y, keys
+
+        # the transpose of the composed matrix applies the reverse of each level
+        t = sm(torch.stack([cols, rows], dim=0), values, size, target.reshape(b * s, -1)).view(b, s, -1)
+
+        return [x, y], [t, target], keys
+
+    def forward_hard(self, x, keys, target=None):
+        """
+        Fast path for evaluation. With hard offsets, each split is a permutation of the indices (if every bucket is
+        divided evenly around its pivot). Instead of building and multiplying a sparse matrix per level, we compose
+        these permutations, and apply the result to the input with a single gather. The intermediate results are only
+        computed if a target is given.
+
+        :return: The same as forward(), or None if one of the splits is not a permutation (for instance because of
+            tied keys). In that case, the Split modules should be used.
+        """
+        b, s, z = x.size()
+
+        ones = torch.ones(b, s, dtype=torch.long, device=keys.device)
+
+        perm = torch.arange(s, device=keys.device)[None, :].expand(b, s)
+        positions, perms = [], []
+
+        current = keys
+        for d in range(len(self.layers)):
+            offset = current > self.pivots(current, d)
+
+            # the position each element moves to
+            pos = util.split(offset[:, None, :], d)[:, 0, :]
+
+            if not (torch.zeros_like(ones).scatter_add_(1, pos, ones) == 1).all():
+                return None
+
+            perm = torch.empty_like(perm).scatter_(1, pos, perm)
+            current = keys.gather(1, perm)
+
+            positions.append(pos)
+            perms.append(perm)
+
+        if target is None:
+            return gather_rows(x, perm), current
+
+        xs = [x] + [gather_rows(x, p) for p in perms]
+
+        t = target
+        targets = [target]
+        for pos in positions[::-1]:
+            t = gather_rows(t, pos)
+            targets.insert(0, t)
+
+        return xs, targets, current
+
+def gather_rows(x, indices):
+    """
+    :param x: A size (b, s, z) tensor
+    :param indices: A size (b, s) LongTensor
+    :return: The tensor y with y[i, j, :] = x[i, indices[i, j], :]
+    """
+    b, s = indices.size()
+
+    return x.gather(1, indices[:, :, None].expand(b, s, x.size(2)))
+
+def compose(sample, rows, cols, values, prune=0.0):
+    """
+    Multiplies the mixture of permutations of a split (from the left) with a block-diagonal sparse matrix.
+
+    :param sample: A pair (indices, probs) of size (b, n, s) tensors, as returned by Split.sample()
+    :param rows: The row indices of the nonzero entries of a (b*s, b*s) matrix
+    :param cols: The column indices of the nonzero entries
+    :param values: The values of the nonzero entries
+    :param prune: Entries of the product with a value of at most this are dropped
+    :return: The rows, columns and values of the product, with duplicate entries summed.
+    """
+    indices, probs = sample
+    b, n, s = indices.size()
+    k = rows.size(0)
+
+    # for each permutation, the row that each row of the block-diagonal matrix moves to, and its weight
+    boffsets = torch.arange(b, device=indices.device)[:, None, None] * s
+    to = (indices + boffsets).permute(1, 0, 2).reshape(n, b * s)
+    probs = probs.permute(1, 0, 2).reshape(n, b * s)
+
+    nvalues = (probs[:, rows] * values[None, :]).reshape(-1)
+    nrows = to[:, rows].reshape(-1)
+    ncols = cols[None, :].expand(n, k).reshape(-1)
+
+    # sum the duplicates
+    flat, inverse = torch.unique(nrows * (b * s) + ncols, return_inverse=True)
+    nvalues = torch.zeros(flat.size(0), dtype=nvalues.dtype, device=nvalues.device).index_add(0, inverse, nvalues)
+
+    keep = nvalues > prune
+    flat, nvalues = flat[keep], nvalues[keep]
+
+    return flat // (b * s), flat % (b * s), nvalues
+
 def median(x, keepdim=False):
+    """
+    The median of each row: the mean of the two middle elements (for rows of even length). These are found by
+    selection (kthvalue) rather than by sorting the rows.
+    """
     b, s = x.size()
 
-    y = x.sort(dim=1)[0][:, s//2-1:s//2+1].mean(dim=1, keepdim=keepdim)
+    lo = x.kthvalue(max(s//2, 1), dim=1, keepdim=keepdim)[0]
+    hi = x.kthvalue(min(s//2 + 1, s), dim=1, keepdim=keepdim)[0]
 
-    return y
+    return (lo + hi) / 2
 
 if __name__ == '__main__':
 
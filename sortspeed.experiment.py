@@ -0,0 +1,119 @@
+import sort
+import torch, random
+import time
+import numpy as np
+
+from argparse import ArgumentParser
+
+"""
+Benchmark: the time of a forward and backward pass through a SortLayer in training mode, with the permutations applied
+level by level, or composed into a single sparse matrix first (SortLayer(..., compose=True)), for increasingly wide
+payloads.
+"""
+
+def run(model, x, keys, t, cuda):
+
+    if cuda:
+        torch.cuda.synchronize()
+    tic = time.time()
+
+    ys, ts, _ = model(x, keys=keys, target=t)
+    loss = ((ys[-1] - t) ** 2).sum() + (ts[0] ** 2).sum()
+    loss.backward()
+
+    if cuda:
+        torch.cuda.synchronize()
+
+    return time.time() - tic
+
+def go(arg):
+
+    torch.manual_seed(arg.seed)
+    random.seed(arg.seed)
+
+    level = sort.SortLayer(arg.size, additional=arg.additional, backend=arg.backend)
+    composed = sort.SortLayer(arg.size, additional=arg.additional, backend=arg.backend, compose=True, prune=arg.prune)
+
+    if arg.cuda:
+        level.cuda()
+        composed.cuda()
+
+    print('{:>8} {:>12} {:>12}'.format('width', 'level (s)', 'composed (s)'))
+
+    for width in arg.widths:
+        times = np.zeros((2, arg.reps))
+
+        for r in range(arg.reps + 1):
+            x = torch.randn(arg.batch, arg.size, width)
+            keys = torch.randn(arg.batch, arg.size, requires_grad=True)
+            t = torch.randn(arg.batch, arg.size, width)
+
+            if arg.cuda:
+                x, t = x.cuda(), t.cuda()
+                keys = keys.detach().cuda().requires_grad_()
+
+            x.requires_grad = True
+
+            for i, model in enumerate([level, composed]):
+                seconds = run(model, x, keys, t, arg.cuda)
+
+                # the first repeat is a warmup
+                if r > 0:
+                    times[i, r - 1] = seconds
+
+        print('{:8} {:12.4f} {:12.4f}'.format(width, *times.mean(axis=1)))
+
+if __name__ == "__main__":
+
+    ## Parse the command line options
+    parser = ArgumentParser()
+
+    parser.add_argument("-s", "--size",
+                        dest="size",
+                        help="Number of elements to sort.",
+                        default=256, type=int)
+
+    parser.add_argument("-w", "--widths",
+                        dest="widths",
+                        help="Payload widths to test.",
+                        nargs='+', default=[1, 16, 256, 4096], type=int)
+
+    parser.add_argument("-b", "--batch-size",
+                        dest="batch",
+                        help="The batch size.",
+                        default=16, type=int)
+
+    parser.add_argument("-a", "--additional",
+                        dest="additional",
+                        help="Number of additional permutations sampled per level.",
+                        default=2, type=int)
+
+    parser.add_argument("-P", "--prune",
+                        dest="prune",
+                        help="Pruning threshold for the composed matrix.",
+                        default=1e-3, type=float)
+
+    parser.add_argument("-K", "--backend",
+                        dest="backend",
+                        help="How the splits apply their permutations (sparse, gather).",
+                        default='sparse', type=str)
+
+    parser.add_argument("-R", "--repeats",
+                        dest="reps",
+                        help="Number of repeats.",
+                        default=10, type=int)
+
+    parser.add_argument("-c", "--cuda", dest="cuda",
+                        help="Whether to use cuda.",
+                        action="store_true")
+
+    parser.add_argument("-r", "--random-seed",
+                        dest="seed",
+                        help="Random seed.",
+                        default=0, type=int)
+
+    options = parser.parse_args()
+
+    print('OPTIONS ', options)
+
+    go(options)
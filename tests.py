@@ -1,5 +1,8 @@
-import hyper, gaussian
+import gaussian, globalsampling, sort, util
 import torch
+import pathlib, tempfile, random
+
+from frozen import load_sparse
 
 def test_fi():
     input = torch.LongTensor([[0, 0], [0, 1], [1, 0], [1, 1]])
@@ -18,19 +21,432 @@ def test_fi_mat():
 
     print(actual)
 
-def test_sort():
-    indices = torch.LongTensor([[[6, 3], [1, 2]], [[5, 8], [1, 3]]])
-    vals = torch.FloatTensor([[0.1, 0.2], [0.3, 0.4]])
+def test_duplicates():
+    tuples = torch.LongTensor([[[3, 1], [3, 2], [3, 1], [0, 3], [0, 2], [3, 0], [0, 3], [0, 0]]])
+    expected = torch.tensor([[0, 0, 1, 0, 0, 0, 1, 0]]).bool()
+
+    assert (util.duplicates(tuples).bool() == expected).all()
+    assert (util.duplicates(tuples, shape=(4, 4)).bool() == expected).all()
+
+    # large indices should not overflow into false duplicates
+    big = torch.LongTensor([[[2**40, 1], [1, 2**40], [2**40, 1]]])
+    assert util.duplicates(big).bool().tolist() == [[False, False, True]]
+
+def test_median():
+    for s in [1, 2, 7, 8]:
+        x = torch.randn(3, s)
+        expected = x.sort(dim=1)[0][:, max(s//2-1, 0):s//2+1].mean(dim=1)
+
+        assert torch.allclose(sort.median(x), expected)
+
+def test_sort_hard():
+    model = sort.SortLayer(8)
+
+    x = torch.randn(2, 8, 3)
+    keys = torch.randn(2, 8)
+
+    y, sorted = model(x, keys, train=False)
+
+    expected, order = keys.sort(dim=1)
+    assert torch.allclose(sorted, expected)
+    assert torch.allclose(y, sort.gather_rows(x, order))
+
+def test_sort_topk():
+    model = sort.SortLayer(16, topk=3)
+
+    x = torch.randn(2, 16, 3)
+    keys = torch.randn(2, 16)
+
+    y, top = model(x, keys, train=False)
+
+    expected, order = keys.sort(dim=1)
+    assert torch.allclose(top[:, :3], expected[:, :3])
+    assert torch.allclose(y[:, :3], sort.gather_rows(x, order)[:, :3])
+
+def test_sort_compose():
+    torch.manual_seed(0)
+
+    level = sort.SortLayer(8)
+    composed = sort.SortLayer(8, compose=True)
+
+    x = torch.randn(2, 8, 3)
+    keys = torch.randn(2, 8)
+    t = torch.randn(2, 8, 3)
+
+    # without additional samples, the permutations are the same for both
+    ys, ts, sorted = level(x, keys, target=t)
+    yc, tc, sortedc = composed(x, keys, target=t)
+
+    assert torch.isfinite(sorted).all() and torch.isfinite(ys[-1]).all()
+    assert torch.allclose(sorted, sortedc)
+    assert torch.allclose(ys[-1], yc[-1], atol=1e-6)
+    assert torch.allclose(ts[0], tc[0], atol=1e-6)
+
+def test_sort_lean():
+    # four levels, so that checkpoint='all' uses two segments
+    x = torch.randn(2, 16, 3)
+    keys = torch.randn(2, 16, requires_grad=True)
+    t = torch.randn(2, 16, 3)
+
+    ys, ts, sorted = sort.SortLayer(16)(x, keys, target=t)
+    (ys[-1] * t).sum().backward()
+
+    # so that the comparisons below can't pass by comparing NaN to NaN
+    assert torch.isfinite(ys[-1]).all() and torch.isfinite(ts[0]).all() and torch.isfinite(keys.grad).all()
+
+    for checkpoint in [False, 'all']:
+        model = sort.SortLayer(16, checkpoint=checkpoint)
+
+        keysl = keys.detach().clone().requires_grad_()
+        yl, tl, sortedl = model(x, keysl, target=t, intermediates=False)
+
+        assert len(yl) == 2 and len(tl) == 2
+        assert torch.isfinite(yl[-1]).all() and torch.isfinite(tl[0]).all()
+        assert torch.allclose(sortedl, sorted)
+        assert torch.allclose(yl[-1], ys[-1], atol=1e-6)
+        assert torch.allclose(tl[0], ts[0], atol=1e-6)
+
+        (yl[-1] * t).sum().backward()
+        assert torch.allclose(keysl.grad, keys.grad, atol=1e-5)
+
+        # without a target
+        keysl = keys.detach().clone().requires_grad_()
+        y, _ = model(x, keysl, intermediates=False)
+        assert torch.isfinite(y).all()
+
+        (y * t).sum().backward()
+        assert torch.allclose(keysl.grad, keys.grad, atol=1e-5)
+
+def test_sort_ragged():
+    model = sort.SortLayer(8)
+
+    x = torch.randn(2, 6, 3)
+    keys = torch.randn(2, 6)
+    lengths = torch.LongTensor([6, 4])
+
+    x[1, 4:] = float('nan') # garbage beyond the length should not leak into the padding
+
+    y, sorted = model(x, keys, train=False, lengths=lengths)
+
+    for i, l in enumerate(lengths.tolist()):
+        expected, order = keys[i, :l].sort()
+
+        assert torch.allclose(sorted[i, :l], expected)
+        assert torch.allclose(y[i, :l], x[i, order])
+        assert torch.isinf(sorted[i, l:]).all() and (y[i, l:] == 0).all()
+
+def test_mixperm():
+    b, n, s, z = 2, 3, 8, 4
+
+    indices = torch.stack([torch.randperm(s) for _ in range(b * n)]).view(b, n, s)
+    probs = torch.rand(b, n, s, dtype=torch.double, requires_grad=True)
+    x = torch.randn(b, s, z, dtype=torch.double, requires_grad=True)
+
+    for scatter in [True, False]:
+        template = torch.arange(s)[None, None, :, None].expand(b, n, s, 2).contiguous()
+        template[:, :, :, 0 if scatter else 1] = indices
+
+        expected = util.batchmm(template.view(b, -1, 2), probs.view(b, -1), (s, s), x)
+        assert torch.allclose(util.MixPerm.apply(indices, probs, x, scatter), expected)
+
+        assert torch.autograd.gradcheck(lambda p, x : util.MixPerm.apply(indices, p, x, scatter), (probs, x))
+
+def test_importance():
+    torch.manual_seed(0)
+
+    importance = util.Importance('topk', explore=0.0)
+
+    # every component is visited once before any is revisited
+    seen = torch.zeros(8, dtype=torch.bool)
+    for _ in range(4):
+        mask = importance.select(8, 2)
+        assert mask.sum() == 2 and not (mask & seen).any()
+        seen |= mask
+
+        x = torch.randn(3, 8, 4, requires_grad=True)
+        importance.track(x, mask)
+        (x * torch.randn(3, 8, 4)).sum().backward()
+
+    assert not torch.isinf(importance.estimate).any()
+
+    # the estimate is stored in the state dict
+    loaded = util.Importance('topk')
+    loaded.load_state_dict(importance.state_dict())
+    assert torch.equal(loaded.estimate, importance.estimate)
+
+    # with exploration, a component with a low estimate is still selected now and then
+    importance = util.Importance('topk', explore=0.5)
+    importance.estimate = torch.tensor([1.0, 1.0, 1.0, 0.0])
+
+    assert any(importance.select(4, 2)[3] for _ in range(100))
+
+def test_shared_weight():
+    # the parameters don't depend on the input, so a shared weight should give the same result as separate copies
+    samplers = [(gaussian, {}), (globalsampling, {'relative_range': (4, 4), 'rr_additional': 0})]
+
+    for module, kwargs in samplers:
+        unshared = module.ParamASHLayer((8,), (8,), k=16, has_bias=True, **kwargs)
+        shared = module.ParamASHLayer((8,), (8,), k=16, has_bias=True, shared_weight=True, **kwargs)
+        shared.load_state_dict(unshared.state_dict())
+
+        x = torch.randn(4, 8)
+        t = torch.randn(4, 8)
+
+        for train in [True, False]:
+            results = []
+            for layer in [unshared, shared]:
+                layer.zero_grad()
+
+                y = layer(x, train=train)
+                (y * t).sum().backward()
+
+                results.append((y.detach(), layer.params.grad.clone(), layer.bias.grad.clone()))
+
+            for a, b in zip(*results):
+                assert torch.allclose(a, b, atol=1e-5)
+
+    # with reinforce, the distribution and the sample should match the batch of the output
+    layer = gaussian.ParamASHLayer((8,), (8,), k=16, reinforce=True, shared_weight=True)
+
+    y, dists, actions = layer(torch.randn(4, 8))
+    loss = (y ** 2).mean(dim=1)
+
+    assert dists.log_prob(actions).size(0) == 4
+    (dists.log_prob(actions) * loss.detach()[:, None, None]).mean().backward()
 
-    hyper.sort(indices, vals)
+def test_hyper_cache():
+    layer = gaussian.ParamASHLayer((8,), (8,), k=16, hyper_cache=4)
+    cache = layer.hyper_cache
 
-    print(indices)
-    print(vals)
+    x = torch.randn(4, 8)
 
+    with torch.no_grad():
+        first = layer(x, train=False)
+        assert torch.equal(first, layer(x, train=False))
+        assert cache.hits == 1 and cache.misses == 1
+
+        # a change of mode or of the parameters invalidates the entries
+        layer.eval()
+        layer(x, train=False)
+        assert cache.misses == 2
+
+        layer.params.add_(1.0)
+        assert not torch.allclose(first, layer(x, train=False))
+        assert cache.misses == 3
+
+    # the cache is not used if gradients are needed
+    layer(x, train=False)
+    assert cache.hits == 1 and cache.misses == 3
+
+def test_freeze():
+    for module in [gaussian, globalsampling]:
+        layer = module.ParamASHLayer((8,), (8,), k=16, has_bias=True)
+        frozen = layer.freeze()
+
+        x = torch.randn(4, 8)
+        assert torch.allclose(layer(x, train=False), frozen(x), atol=1e-5)
+
+        # fewer than 256 distinct values, so the codebook is exact
+        assert torch.allclose(frozen(x), frozen.quantize('codebook', chunk=3)(x), atol=1e-5)
+        assert torch.allclose(frozen(x), frozen.quantize('int8')(x), atol=0.1)
+
+    # both samplers freeze through hyper_frozen()
+    for module in [gaussian, globalsampling]:
+        layer = module.ParamASHLayer((8,), (8,), k=16)
+        hyper = layer.hyper
+        layer.hyper_frozen = lambda input : (lambda m, s, v : (m, s, v * 2.0))(*hyper(input))
+
+        x = torch.randn(4, 8)
+        assert torch.allclose(layer.freeze()(x), 2.0 * layer(x, train=False), atol=1e-5)
+
+    # the values of a weight sharing layer are sampled in the forward, but not in freeze()
+    layer = gaussian.WeightSharingASHLayer((8,), (8,), k=16, num_values=4)
+    first, second = layer.freeze(), layer.freeze()
+
+    x = torch.randn(4, 8)
+    assert torch.equal(first.values, second.values)
+    assert torch.allclose(first(x), second(x))
+
+    # each component gets its most likely value (duplicate index tuples are summed, so compare the totals)
+    with torch.no_grad():
+        values = layer.hyper(x[:1], sample=False)[2]
+    assert torch.allclose(first.values.sum(), values.sum(), atol=1e-5)
+
+def test_chunks():
+    # no random tuples are sampled, so splitting the batch shouldn't change the result
+    samplers = [(gaussian, {}, {'subsample': 0.5}),
+                (globalsampling, {'relative_range': (4, 4), 'rr_additional': 0}, {'subsample': 8})]
+
+    for module, kwargs, subsample in samplers:
+        # with subsampling, the same means should be learned over in every micro-batch
+        for skwargs in [{}, subsample]:
+            layer = module.ParamASHLayer((8,), (8,), k=16, has_bias=True, **kwargs, **skwargs)
+
+            x = torch.randn(4, 8)
+            t = torch.randn(4, 8)
+
+            for train in [False, True]:
+                results = []
+                for max in [None, 1]: # 1: one instance per chunk
+                    layer.max_tuples_per_chunk = max
+                    layer.zero_grad()
+
+                    torch.manual_seed(0)
+                    random.seed(0)
+
+                    y = layer(x, train=train)
+                    (y * t).sum().backward()
+
+                    results.append((y.detach(), layer.params.grad.clone(), layer.bias.grad.clone()))
+
+                for a, b in zip(*results):
+                    assert torch.allclose(a, b, atol=1e-5)
+
+    # with random tuples, the micro-batches should not all sample the same ones
+    samplers = [(gaussian, {}), (globalsampling, {'relative_range': (4, 4), 'rr_additional': 4})]
+
+    for module, kwargs in samplers:
+        layer = module.ParamASHLayer((8,), (8,), k=16, additional=4, max_tuples_per_chunk=1, **kwargs)
+
+        # the parameters don't depend on the input, so identical instances differ only in their samples
+        x = torch.randn(1, 8).repeat(4, 1)
+
+        y = layer(x, seed=7)
+        assert not all(torch.equal(y[0], y[i]) for i in range(1, 4))
+
+def test_checkpoint():
+    samplers = [(gaussian, {}), (globalsampling, {'relative_range': (4, 4), 'rr_additional': 4})]
+
+    for module, kwargs in samplers:
+        plain = module.ParamASHLayer((8,), (8,), k=16, additional=4, has_bias=True, **kwargs)
+        layer = module.ParamASHLayer((8,), (8,), k=16, additional=4, has_bias=True, checkpoint=True, **kwargs)
+        layer.load_state_dict(plain.state_dict())
+
+        x = torch.randn(4, 8)
+        t = torch.randn(4, 8)
+
+        results = []
+        for l in [plain, layer]:
+            torch.manual_seed(0)
+            random.seed(0)
+
+            y = l(x)
+            (y * t).sum().backward()
+
+            results.append((y.detach(), l.params.grad.clone(), l.bias.grad.clone()))
+
+        for a, b in zip(*results):
+            assert torch.allclose(a, b, atol=1e-5)
+
+def test_forward_chunked():
+    layer = globalsampling.ParamASHLayer((8,), (8,), k=16, additional=4, has_bias=True, subsample=4,
+                                         relative_range=(4, 4), rr_additional=4)
+    x = torch.randn(4, 8)
+
+    loss_fn = lambda y : (y ** 2).mean()
+
+    layer.zero_grad()
+    loss = layer.forward_chunked(x, loss_fn, 4, seed=0)
+    grad = layer.params.grad.clone()
+
+    layer.zero_grad()
+    losses = []
+    for fr in range(0, 16, 4):
+        l = loss_fn(layer(x, mrange=(fr, fr + 4), seed=0))
+        l.backward()
+
+        losses.append(l.item())
+
+    assert abs(loss.item() - sum(losses) / len(losses)) < 1e-5
+    assert torch.allclose(grad, layer.params.grad, atol=1e-5)
+
+def test_workspace():
+    workspace = util.Workspace()
+
+    large = workspace.get('x', (4, 3), torch.long)
+    small = workspace.get('x', (2, 3), torch.long)
+
+    # a smaller request is a view of the same buffer
+    assert workspace.allocations == 1 and small.size() == (2, 3)
+    assert small.data_ptr() == large.data_ptr()
+
+    workspace.get('x', (2, 3))
+    assert workspace.allocations == 2
+
+    # with uneven micro-batches, the buffers are allocated in the first step only, and the result doesn't change
+    kwargs = {'k' : 16, 'additional' : 4, 'relative_range' : (4, 4), 'rr_additional' : 4,
+              'max_tuples_per_chunk' : 3 * 16 * 12 * 16} # chunks of 3 and 1 instances
+    plain = globalsampling.ParamASHLayer((8,), (8,), **kwargs)
+    layer = globalsampling.ParamASHLayer((8,), (8,), workspace=True, **kwargs)
+    layer.load_state_dict(plain.state_dict())
+
+    x = torch.randn(4, 8)
+
+    for step in range(2):
+        assert torch.allclose(plain(x, seed=step), layer(x, seed=step), atol=1e-5)
+
+        if step == 0:
+            allocations = layer.workspace.allocations
+
+    assert layer.workspace.allocations == allocations
+
+def test_replay():
+    samplers = [(gaussian, {}), (globalsampling, {'relative_range': (4, 4), 'rr_additional': 4})]
+
+    for module, kwargs in samplers:
+        layer = module.ParamASHLayer((8,), (8,), k=16, additional=4, **kwargs)
+        x = torch.randn(4, 8)
+        t = torch.randn(4, 8)
+
+        results = []
+        for replay in [False, True]:
+            layer.replay = replay
+            layer.zero_grad()
+
+            y = layer(x, seed=0)
+            (y * t).sum().backward()
+
+            results.append((y.detach(), layer.params.grad.clone()))
+
+        (y0, g0), (y1, g1) = results
+        assert torch.allclose(y0, y1, atol=1e-5)
+        assert torch.allclose(g0, g1, atol=1e-5)
+
+def test_export_sparse(tmp_path):
+    frozen = globalsampling.ParamASHLayer((8,), (8,), k=16, has_bias=True).freeze()
+    x = torch.randn(4, 8)
+
+    for i, layer in enumerate([frozen, frozen.quantize('codebook')]):
+        path = str(tmp_path / str(i))
+
+        layer.export_sparse(path)
+        loaded = load_sparse(path, mmap=True)
+
+        assert torch.allclose(layer(x), loaded(x))
 
 
 if __name__ == '__main__':
     # unittest.main()
 
     test_fi()
-    test_fi_mat()
\ No newline at end of file
+    test_fi_mat()
+    test_duplicates()
+    test_median()
+    test_sort_hard()
+    test_mixperm()
+    test_sort_ragged()
+    test_sort_compose()
+    test_sort_lean()
+    test_sort_topk()
+    test_importance()
+    test_shared_weight()
+    test_hyper_cache()
+    test_freeze()
+    test_chunks()
+    test_checkpoint()
+    test_forward_chunked()
+    test_workspace()
+    test_replay()
+
+    with tempfile.TemporaryDirectory() as dir:
+        test_export_sparse(pathlib.Path(dir))
\ No newline at end of file
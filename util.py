@@ -13,6 +13,7 @@ from torch import nn
 from torch import FloatTensor, LongTensor
 from torch.autograd import Variable
 from torch.utils.data import sampler, dataloader
+import torch.utils.checkpoint
 
 import torchvision
 
@@ -349,70 +350,132 @@ class SparseMultCPU(torch.autograd.Function):
     Sparse matrix multiplication with gradients over the value-vector
 
     Does not work with batch dim.
+
+    Only the indices, the values and the vector are kept for the backward, through save_for_backward (so that
+    activation checkpointing can discard them). The sparse matrix is rebuilt from these in the backward.
     """
 
     @staticmethod
     def forward(ctx, indices, values, size, vector):
 
-        # print(type(size), size, list(size), intlist(size))
-        # print(indices.size(), values.size(), torch.Size(intlist(size)))
-
-        matrix = torch.sparse.FloatTensor(indices, values, torch.Size(intlist(size)))
+        size = torch.Size(intlist(size))
+        matrix = torch.sparse_coo_tensor(indices, values, size)
 
-        ctx.indices, ctx.matrix, ctx.vector = indices, matrix, vector
+        ctx.size = size
+        ctx.save_for_backward(indices, values, vector)
 
         return torch.mm(matrix, vector.unsqueeze(1))
 
     @staticmethod
     def backward(ctx, grad_output):
-        grad_output = grad_output.data
+        indices, values, vector = ctx.saved_tensors
 
         # -- this will break recursive autograd, but it's the only way to get grad over sparse matrices
+        grad_output = grad_output.detach()
+        matrix = torch.sparse_coo_tensor(indices.detach(), values.detach(), ctx.size)
 
-        i_ixs = ctx.indices[0,:]
-        j_ixs = ctx.indices[1,:]
+        i_ixs = indices[0,:]
+        j_ixs = indices[1,:]
         output_select = grad_output.view(-1)[i_ixs]
-        vector_select = ctx.vector.view(-1)[j_ixs]
+        vector_select = vector.detach().view(-1)[j_ixs]
 
         grad_values = output_select *  vector_select
 
-        grad_vector = torch.mm(ctx.matrix.t(), grad_output).t()
-        return None, Variable(grad_values), None, Variable(grad_vector)
+        grad_vector = torch.mm(matrix.t(), grad_output).view(vector.size())
+        return None, grad_values, None, grad_vector
 
-class SparseMultGPU(torch.autograd.Function):
+class SparseMultGPU(SparseMultCPU):
 
     """
-    Sparse matrix multiplication with gradients over the value-vector
+    Sparse matrix multiplication with gradients over the value-vector, on the GPU. The sparse matrix is created on the
+    device of the indices, so this is the same as SparseMultCPU.
+    """
+
+class ReplayMult(torch.autograd.Function):
+
+    """
+    Sparse matrix multiplication with gradients over the value-vector (like SparseMultCPU), for a matrix whose indices
+    can be regenerated. The indices are not kept for the backward: only a function that recomputes them is.
 
     Does not work with batch dim.
     """
 
     @staticmethod
-    def forward(ctx, indices, values, size, vector):
-
-        # print(type(size), size, list(size), intlist(size))
+    def forward(ctx, indices, regenerate, values, size, vector):
 
-        matrix = torch.cuda.sparse.FloatTensor(indices, values, torch.Size(intlist(size)))
+        matrix = torch.sparse_coo_tensor(indices, values, torch.Size(intlist(size)))
 
-        ctx.indices, ctx.matrix, ctx.vector = indices, matrix, vector
+        ctx.regenerate, ctx.size = regenerate, size
+        ctx.save_for_backward(values, vector)
 
         return torch.mm(matrix, vector.unsqueeze(1))
 
     @staticmethod
     def backward(ctx, grad_output):
-        grad_output = grad_output.data
+        values, vector = ctx.saved_tensors
 
-        # -- this will break recursive autograd, but it's the only way to get grad over sparse matrices
+        indices = ctx.regenerate()
+        matrix = torch.sparse_coo_tensor(indices, values, torch.Size(intlist(ctx.size)))
 
-        i_ixs = ctx.indices[0,:]
-        j_ixs = ctx.indices[1,:]
+        i_ixs = indices[0,:]
+        j_ixs = indices[1,:]
         output_select = grad_output.view(-1)[i_ixs]
-        vector_select = ctx.vector.view(-1)[j_ixs]
+        vector_select = vector.view(-1)[j_ixs]
 
         grad_values = output_select *  vector_select
 
-        grad_vector = torch.mm(ctx.matrix.t(), grad_output).t()
-        return None, Variable(grad_values), None, Variable(grad_vector)
+        grad_vector = torch.mm(matrix.t(), grad_output).view(vector.size())
+        return None, None, grad_values, None, grad_vector
+
+class ReplayDensities(torch.autograd.Function):
+
+    """
+    Computes density(points, means, sigmas) without keeping the points (or any intermediate values) for the backward.
+    Only the means and sigmas are kept, with a function that regenerates the points, and the densities are recomputed
+    from these in the backward. Gradients are computed for the means and sigmas only.
+    """
+
+    @staticmethod
+    def forward(ctx, points, regenerate, density, means, sigmas):
+
+        ctx.regenerate, ctx.density = regenerate, density
+        ctx.save_for_backward(means, sigmas)
+
+        return density(points, means, sigmas)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        means, sigmas = ctx.saved_tensors
+
+        points = ctx.regenerate()
+
+        with torch.enable_grad():
+            means, sigmas = means.detach().requires_grad_(), sigmas.detach().requires_grad_()
+            result = ctx.density(points, means, sigmas)
+
+            grad_means, grad_sigmas = torch.autograd.grad(result, (means, sigmas), grad_output)
+
+        return None, None, None, grad_means, grad_sigmas
+
+def draw_seed():
+    """
+    Draws a seed for a torch.Generator from the global random state (so that runs seeded with torch.manual_seed
+    remain reproducible).
+    """
+    return int(torch.randint(2 ** 62, (1,)))
+
+def generator(seed, device='cpu'):
+    """
+    :return: A torch.Generator seeded with the given seed, or None if the seed is None (so that the global random
+        state is used).
+    """
+    if seed is None:
+        return None
+
+    gen = torch.Generator(device=device)
+    gen.manual_seed(seed)
+
+    return gen
 
 def nvidia_smi():
     command = 'nvidia-smi'
@@ -616,6 +679,301 @@ class ChunkSampler(sampler.Sampler):
     def __len__(self):
         return self.num
 
+class Importance(nn.Module):
+    """
+    Chooses which of the k components (index tuples) of a hyperlayer to learn over in subsample mode, based on a running
+    estimate of the magnitude of the gradient on each component.
+
+    Components that have never been selected have infinite importance, so every component is visited at least once.
+    The estimates are a (non-trainable) buffer, so they are stored in the state dict of the layer.
+
+    Arguments:
+        mode: 'topk' selects the components with the highest estimate, 'proportional' samples components (without
+            replacement) with probability proportional to their estimate.
+        decay: Decay of the running estimate.
+        explore: The proportion of the selection that is sampled uniformly instead. Without this, a component whose
+            estimate is stale and low is never selected again in topk mode, so its estimate is never updated.
+    """
+
+    def __init__(self, mode='topk', decay=0.9, explore=0.1):
+        super().__init__()
+
+        assert mode in ('topk', 'proportional')
+
+        self.mode = mode
+        self.decay = decay
+        self.explore = explore
+
+        # the size is only known at the first call to select()
+        self.register_buffer('estimate', torch.zeros(0))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # resize the buffer to the stored estimate, so that it can be copied in
+        key = prefix + 'estimate'
+        if key in state_dict:
+            self.estimate = torch.empty_like(state_dict[key], device=self.estimate.device)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def select(self, k, num, device='cpu'):
+        """
+        :param k: Total number of components.
+        :param num: Number of components to select.
+        :return: A length-k boolean mask, with num components selected.
+        """
+        if self.estimate.size(0) != k:
+            self.estimate = torch.full((k,), float('inf'), device=device)
+        self.estimate = self.estimate.to(device)
+
+        num = max(1, min(num, k))
+        unseen = torch.isinf(self.estimate)
+
+        nunseen = int(unseen.sum())
+
+        if nunseen >= num:
+            idx = self.estimate.topk(num)[1]
+        elif self.mode == 'topk':
+            # each slot is given to a uniformly sampled component with probability explore
+            nexplore = int((torch.rand(num) < self.explore).sum())
+
+            idx = self.estimate.topk(num - nexplore)[1]
+
+            if nexplore > 0:
+                rest = torch.ones(k, device=device)
+                rest[idx] = 0.0
+
+                idx = torch.cat([idx, torch.multinomial(rest, nexplore, replacement=False)], dim=0)
+        else:
+            # the unseen components are always included, the rest are sampled
+            weights = self.estimate + 1e-12
+            weights[unseen] = 0.0
+            weights = (1.0 - self.explore) * weights / weights.sum() + self.explore / (k - nunseen)
+            weights[unseen] = 0.0
+
+            sampled = torch.multinomial(weights, num - nunseen, replacement=False)
+
+            idx = torch.cat([unseen.nonzero().view(-1), sampled], dim=0)
+
+        mask = torch.zeros(k, dtype=torch.bool, device=device)
+        mask[idx] = True
+
+        return mask
+
+    def track(self, input, mask):
+        """
+        Registers a hook on input, so that its gradient is used to update the estimates of the selected components.
+        Call this once per step, on the tensor that all (micro-batches of the) forward passes use, so that the estimate
+        is updated once, from the gradient of the whole batch.
+
+        :param input: A tensor of size (b, k, ...), containing all components. Only the gradients of the selected ones
+            are used.
+        :param mask: The mask returned by select().
+        """
+        if not input.requires_grad:
+            return
+
+        def hook(grad):
+            grad = grad[:, mask]
+            b, n = grad.size()[:2]
+            mag = grad.detach().view(b, n, -1).norm(dim=2).mean(dim=0)
+
+            old = self.estimate[mask]
+            self.estimate[mask] = torch.where(torch.isinf(old), mag, self.decay * old + (1.0 - self.decay) * mag)
+
+        input.register_hook(hook)
+
+def checkpoint(function, *args, **kwargs):
+    """
+    Calls function(*args, **kwargs) without storing its intermediate values for the backward. These are recomputed
+    in the backward instead (see torch.utils.checkpoint).
+
+    Pytorch restores its own random state for the recomputation. The state of the python random module (used by some
+    of the samplers) is restored here, so that the recomputation draws the same samples as the original call.
+    """
+    state = random.getstate()
+    calls = [0]
+
+    def replay(*args, **kwargs):
+        calls[0] += 1
+        if calls[0] == 1:
+            return function(*args, **kwargs)
+
+        current = random.getstate()
+        random.setstate(state)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            random.setstate(current)
+
+    return torch.utils.checkpoint.checkpoint(replay, *args, use_reentrant=False, **kwargs)
+
+def chunk_bounds(batchsize, size, max_size):
+    """
+    Splits a batch into consecutive micro-batches, so that each contains at most max_size elements, if every instance
+    contributes 'size' elements. Each micro-batch contains at least one instance.
+
+    :return: A list of (from, to) pairs
+    """
+    per = max(1, max_size // max(1, size))
+
+    return [(fr, min(fr + per, batchsize)) for fr in range(0, batchsize, per)]
+
+def chunk_seeds(seed, num):
+    """
+    Derives a seed for each of num micro-batches from a single seed, so that the micro-batches don't all draw the same
+    samples. The result is determined by the seed, so it can be used for replay.
+
+    :return: A list of num seeds (all None if seed is None)
+    """
+    if seed is None:
+        return [None] * num
+
+    gen = torch.Generator().manual_seed(seed)
+
+    return torch.randint(2 ** 62, (num,), generator=gen).tolist()
+
+class Workspace():
+    """
+    A set of named buffers that are kept between calls, for intermediate results whose size doesn't change (or doesn't
+    grow) from one forward to the next. Each buffer is a flat tensor, of which a view of the requested size is
+    returned, so it is only reallocated when a larger size, or a different dtype or device is requested. Smaller
+    requests, like the last micro-batch of a chunked forward, reuse the buffer.
+
+    The buffers are overwritten in every call, so they should only hold tensors that are used up within the forward.
+    A tensor that autograd saves for the backward should not be stored here.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+
+    def get(self, name, size, dtype=torch.float, device='cpu'):
+        """
+        :return: A tensor of the given size, dtype and device. Its contents are undefined.
+        """
+        size = torch.Size(size)
+        device = torch.device(device)
+        numel = size.numel()
+
+        buffer = self.buffers.get(name)
+
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype or buffer.device.type != device.type \
+                or (device.index is not None and buffer.device.index != device.index):
+            buffer = torch.empty(numel, dtype=dtype, device=device)
+
+            self.buffers[name] = buffer
+            self.allocations += 1
+
+        return buffer[:numel].view(size)
+
+    def clear(self):
+        self.buffers.clear()
+
+class HyperCache():
+    """
+    LRU cache for the output of a hypernetwork, for evaluation loops that see the same inputs many times (over epochs or
+    checkpoints).
+
+    Entries are looked up by a cheap fingerprint of the input batch (and of any tensor keyword arguments to the
+    hypernetwork), together with the version counters of the parameters and buffers of the layer and its train/eval
+    mode, so that any optimizer step or change of mode invalidates them. Each entry keeps a copy of its inputs, to rule
+    out collisions of the fingerprint.
+
+    Arguments:
+        size: Maximum number of entries.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.entries = OrderedDict()
+
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    @staticmethod
+    def fingerprint(input):
+        x = input.detach().reshape(-1)
+        step = max(1, x.size(0) // 256)
+
+        sample = x[::step].double()
+        weights = torch.arange(1, sample.size(0) + 1, dtype=torch.double, device=x.device)
+
+        return (tuple(input.size()), input.dtype, str(input.device), float(x.double().sum()), float((sample * weights).sum()))
+
+    def key(self, module, input, kwargs):
+        args = tuple((name, HyperCache.fingerprint(value) if torch.is_tensor(value) else value)
+                     for name, value in sorted(kwargs.items()))
+
+        version = tuple((id(p), p._version) for p in module.parameters())
+        # constant buffers (see HyperLayer.constant()) never change, but are added as they are first needed
+        constants = set(id(getattr(module, name)) for name in getattr(module, 'constants', {}).values())
+        buffers = tuple((id(b), b._version) for b in module.buffers() if id(b) not in constants)
+        modes = tuple(m.training for m in module.modules())
+
+        return (HyperCache.fingerprint(input),) + args + version + buffers + modes
+
+    def lookup(self, module, input, **kwargs):
+        """
+        Returns the output of module.hyper(input, **kwargs), from the cache if possible.
+        """
+        key = self.key(module, input, kwargs)
+        tensors = [input] + [kwargs[name] for name in sorted(kwargs) if torch.is_tensor(kwargs[name])]
+
+        if key in self.entries:
+            cached, output = self.entries[key]
+
+            if all(torch.equal(c, t) for c, t in zip(cached, tensors)):
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return output
+
+        self.misses += 1
+        output = module.hyper(input, **kwargs)
+
+        self.entries[key] = ([t.detach().clone() for t in tensors], output)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+        return output
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries)}
+
+# the maximum number of tensors kept by constant()
+MAX_CONSTANTS = 256
+constants = OrderedDict()
+
+def constant(data, dtype=torch.float, device='cpu'):
+    """
+    Returns a tensor containing the given data. The tensor is only created (and copied to the device) the first time
+    a given (data, dtype, device) combination is asked for. After that the same tensor is returned, so that small
+    size and range tensors don't need to be rebuilt from python lists in every forward pass. The cache holds at most
+    MAX_CONSTANTS tensors: the least recently used one is dropped first, so that varying batch sizes or shapes don't
+    make it grow without bound.
+
+    The result is shared by all callers, so it should never be modified in place.
+
+    :param data: A sequence of numbers: a tuple, a list or a range.
+    :return:
+    """
+    key = (data if isinstance(data, (tuple, range)) else tuple(data), dtype, str(device))
+
+    if key in constants:
+        constants.move_to_end(key)
+        return constants[key]
+
+    constants[key] = result = torch.tensor(list(data), dtype=dtype, device=device)
+
+    while len(constants) > MAX_CONSTANTS:
+        constants.popitem(last=False)
+
+    return result
+
 def bmult(width, height, num_indices, batchsize, use_cuda):
     """
     ?
@@ -627,9 +985,10 @@ def bmult(width, height, num_indices, batchsize, use_cuda):
     :param use_cuda:
     :return:
     """
+    dv = 'cuda' if use_cuda else 'cpu'
 
-    bmult = torch.cuda.LongTensor([height, width]) if use_cuda else LongTensor([height, width])
-    m = torch.cuda.LongTensor(range(batchsize)) if use_cuda else LongTensor(range(batchsize))
+    bmult = constant((int(height), int(width)), torch.long, dv)
+    m = constant(range(batchsize), torch.long, dv)
 
     bmult = bmult.unsqueeze(0).unsqueeze(0)
     m     = m.unsqueeze(1).unsqueeze(1)
@@ -746,29 +1105,84 @@ def normalize(indices, values, size, row=True, cuda=None, epsilon=0.00000001):
 #     print(normalize(tind, tv, (5, 5), row=False))
 
 
-PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97]
+def linearize(tuples, shape=None):
+    """
+    Maps each integer tuple (along the last dimension) to a single integer: its index in a tensor of the given shape,
+    after that tensor is flattened by t.view(-1).
+
+    If no shape is given, the smallest box containing all tuples is used. If the number of entries in that box does
+    not fit in a long, the tuples are numbered by torch.unique instead. Either way, two tuples receive the same integer
+    if and only if they are equal.
+
+    :param tuples: A LongTensor of size (..., rank)
+    :param shape: The shape of the tensor that the tuples index (optional)
+    :return: A LongTensor of size (...)
+    """
+    r = tuples.size(-1)
+    dv = tuples.device
+
+    if shape is None:
+        flat = tuples.contiguous().view(-1, r)
+
+        lo = flat.min(dim=0)[0]
+        shape = (flat.max(dim=0)[0] - lo + 1).tolist()
+        tuples = tuples - lo
+
+    if prod(shape) > 2 ** 63 - 1:
+        _, ids = torch.unique(tuples.contiguous().view(-1, r), dim=0, return_inverse=True)
+        return ids.view(tuples.size()[:-1])
+
+    strides = [1] * r
+    for i in range(r - 2, -1, -1):
+        strides[i] = strides[i + 1] * int(shape[i + 1])
+
+    strides = constant(strides, torch.long, dv)
+
+    return (tuples * strides).sum(dim=-1)
 
-def duplicates(tuples):
+def duplicates(tuples, shape=None):
     """
     Takes a list of tuples, and for each tuple that occurs mutiple times marks all but one of the occurences.
 
-    :param tuples: A size (batch, k, rank) tensor of integer tuples
-    :return: A size (batch, k) mask indicating the duplicates
+    :param tuples: A size (..., k, rank) tensor of integer tuples. Duplicates are detected along the k dimension.
+    :param shape: The shape of the tensor that the tuples index (optional, see linearize()).
+    :return: A size (..., k) mask indicating the duplicates
     """
-    b, k, r = tuples.size()
+    k = tuples.size(-2)
+    size = tuples.size()[:-1]
 
-    primes = torch.tensor(PRIMES[:r])
-    primes = primes.unsqueeze(0).unsqueeze(0).expand(b, k, r)
-    unique = ((tuples+1) ** primes).prod(dim=2) # unique identifier for each tuple
+    ids = linearize(tuples, shape).view(-1, k)
 
-    sorted, sort_idx = torch.sort(unique, dim=1)
-    _, unsort_idx = torch.sort(sort_idx, dim=1)
+    sorted, sort_idx = torch.sort(ids, dim=1)
 
     mask = sorted[:, 1:] == sorted[:, :-1]
 
-    mask = torch.cat([torch.zeros(b, 1, dtype=torch.uint8), mask], dim=1)
+    zs = torch.zeros(mask.size(0), 1, dtype=mask.dtype, device=mask.device)
+    mask = torch.cat([zs, mask], dim=1)
+
+    # move the mask back to the original order of the tuples
+    dups = torch.zeros_like(mask).scatter_(1, sort_idx, mask)
+
+    return dups.view(size)
+
+def neighbors(means, floor_mask):
+    """
+    Computes the integer index tuples neighboring each real-valued index tuple, by flooring or ceiling each of its
+    elements.
+
+    :param means: A size (..., rank) tensor of real-valued index tuples
+    :param floor_mask: A size (2^rank, rank) mask, with all binary sequences of length rank as rows (1 for floor, 0 for
+        ceil)
+    :return: A size (..., 2^rank, rank) LongTensor of integer index tuples
+    """
+    size = means.size()
+    rank = size[-1]
+
+    means = means.data.unsqueeze(-2).expand(size[:-1] + (2 ** rank, rank))
+    fm = floor_mask.bool().expand_as(means)
+
+    return torch.where(fm, means.floor(), means.ceil()).long()
 
-    return torch.gather(mask, 1, unsort_idx)
 #
 # if __name__ == "__main__":
 #     # tuples = torch.tensor([
@@ -889,72 +1303,48 @@ class SparseMMCPU(torch.autograd.Function):
     Sparse matrix multiplication with gradients over the value-vector
 
     Does not work with batch dim.
+
+    Only the indices, the values and the dense matrix are kept for the backward, through save_for_backward (so that
+    activation checkpointing can discard them). The sparse matrix is rebuilt from these in the backward.
     """
 
     @staticmethod
     def forward(ctx, indices, values, size, xmatrix):
 
-        # print(type(size), size, list(size), intlist(size))
-        # print(indices.size(), values.size(), torch.Size(intlist(size)))
-
-        matrix = torch.sparse.FloatTensor(indices, values, torch.Size(intlist(size)))
+        size = torch.Size(intlist(size))
+        matrix = torch.sparse_coo_tensor(indices, values, size)
 
-        ctx.indices, ctx.matrix, ctx.xmatrix = indices, matrix, xmatrix
+        ctx.size = size
+        ctx.save_for_backward(indices, values, xmatrix)
 
         return torch.mm(matrix, xmatrix)
 
     @staticmethod
     def backward(ctx, grad_output):
-        grad_output = grad_output.data
+        indices, values, xmatrix = ctx.saved_tensors
 
         # -- this will break recursive autograd, but it's the only way to get grad over sparse matrices
+        grad_output = grad_output.detach()
+        matrix = torch.sparse_coo_tensor(indices.detach(), values.detach(), ctx.size)
 
-        i_ixs = ctx.indices[0,:]
-        j_ixs = ctx.indices[1,:]
+        i_ixs = indices[0,:]
+        j_ixs = indices[1,:]
         output_select = grad_output[i_ixs, :]
-        xmatrix_select = ctx.xmatrix[j_ixs, :]
+        xmatrix_select = xmatrix.detach()[j_ixs, :]
 
         grad_values = (output_select * xmatrix_select).sum(dim=1)
 
-        grad_xmatrix = torch.mm(ctx.matrix.t(), grad_output)
-        return None, Variable(grad_values), None, Variable(grad_xmatrix)
+        grad_xmatrix = torch.mm(matrix.t(), grad_output)
+        return None, grad_values, None, grad_xmatrix
 
 
-class SparseMMGPU(torch.autograd.Function):
+class SparseMMGPU(SparseMMCPU):
 
     """
-    Sparse matrix multiplication with gradients over the value-vector
-
-    Does not work with batch dim.
+    Sparse matrix multiplication with gradients over the value-vector, on the GPU. The sparse matrix is created on the
+    device of the indices, so this is the same as SparseMMCPU.
     """
 
-    @staticmethod
-    def forward(ctx, indices, values, size, xmatrix):
-
-        # print(type(size), size, list(size), intlist(size))
-
-        matrix = torch.cuda.sparse.FloatTensor(indices, values, torch.Size(intlist(size)))
-
-        ctx.indices, ctx.matrix, ctx.xmatrix = indices, matrix, xmatrix
-
-        return torch.mm(matrix, xmatrix)
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        grad_output = grad_output.data
-
-        # -- this will break recursive autograd, but it's the only way to get grad over sparse matrices
-
-        i_ixs = ctx.indices[0,:]
-        j_ixs = ctx.indices[1,:]
-        output_select = grad_output[i_ixs]
-        xmatrix_select = ctx.xmatrix[j_ixs]
-
-        grad_values = (output_select *  xmatrix_select).sum(dim=1)
-
-        grad_xmatrix = torch.mm(ctx.matrix.t(), grad_output)
-        return None, Variable(grad_values), None, Variable(grad_xmatrix)
-
 def batchmm(indices, values, size, xmatrix, cuda=None):
     """
     Multiply a batch of sparse matrices with a batch of dense matrices
@@ -972,9 +1362,9 @@ def batchmm(indices, values, size, xmatrix, cuda=None):
     dv = 'cuda' if cuda else 'cpu'
     height, width = size
 
-    size = torch.tensor(size, device=dv, dtype=torch.long)
+    size = constant((int(height), int(width)), torch.long, dv)
     bmult = size[None, None, :].expand(b, n, 2)
-    m = torch.arange(b, device=dv, dtype=torch.long)[:, None, None].expand(b, n, 2)
+    m = constant(range(b), torch.long, dv)[:, None, None].expand(b, n, 2)
 
     bindices = (m * bmult).view(b*n, r) + indices.view(b*n, r)
 
@@ -989,6 +1379,85 @@ def batchmm(indices, values, size, xmatrix, cuda=None):
 
     return result.view(b, height, -1)
 
+class MixPerm(torch.autograd.Function):
+    """
+    Applies a weighted mixture of (partial) permutations to a batch of matrices. For each instance b, sample n and
+    position j:
+     - if scatter is true, row j of x is added to row indices[b, n, j] of the output, multiplied by probs[b, n, j],
+     - otherwise, row indices[b, n, j] of x is added to row j of the output, multiplied by probs[b, n, j].
+
+    This is the same product as util.batchmm computes for a sparse matrix with these indices and values, but the
+    permutations are applied one at a time with a scatter or a gather, without building a sparse matrix. Only the
+    indices, probs and x are kept for the backward.
+    """
+
+    @staticmethod
+    def forward(ctx, indices, probs, x, scatter):
+        b, n, s = indices.size()
+        z = x.size(2)
+
+        out = torch.zeros(b, s, z, dtype=x.dtype, device=x.device)
+
+        for i in range(n):
+            idx = indices[:, i, :, None].expand(b, s, z)
+            p = probs[:, i, :, None]
+
+            if scatter:
+                out.scatter_add_(1, idx, p * x)
+            else:
+                out.add_(p * x.gather(1, idx))
+
+        ctx.save_for_backward(indices, probs, x)
+        ctx.scatter = scatter
+
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        indices, probs, x = ctx.saved_tensors
+        b, n, s = indices.size()
+        z = x.size(2)
+
+        grad_probs = torch.empty_like(probs)
+        grad_x = torch.zeros_like(x)
+
+        for i in range(n):
+            idx = indices[:, i, :, None].expand(b, s, z)
+            p = probs[:, i, :, None]
+
+            if ctx.scatter:
+                g = grad_output.gather(1, idx)
+
+                grad_probs[:, i, :] = (g * x).sum(dim=2)
+                grad_x.add_(p * g)
+            else:
+                grad_probs[:, i, :] = (grad_output * x.gather(1, idx)).sum(dim=2)
+                grad_x.scatter_add_(1, idx, p * grad_output)
+
+        return None, grad_probs, grad_x, None
+
+def gathermm(indices, values, size, x):
+    """
+    Multiplies a batch of sparse matrices with a batch of vectors, without constructing sparse tensors: the relevant
+    elements of x are gathered, multiplied by the values and summed into the output rows.
+
+    :param indices: A size (b, k, 2) LongTensor of (row, column) indices
+    :param values: A size (b, k) tensor of values
+    :param size: The size (height, width) of the matrices
+    :param x: A size (b, width) batch of vectors
+    :return: A size (b, height) batch of vectors
+    """
+    b, k, _ = indices.size()
+    height = int(size[0])
+
+    rows, cols = indices[:, :, 0], indices[:, :, 1]
+
+    products = values * x.gather(1, cols)
+
+    y = torch.zeros(b, height, dtype=products.dtype, device=products.device)
+
+    return y.scatter_add(1, rows, products)
+
 def split(offset, depth):
     dv = 'cuda' if offset.is_cuda else 'cpu'
 
@@ -1000,9 +1469,9 @@ def split(offset, depth):
     numbuckets = 2 ** depth # number of buckets in the input
     bsize      = s // numbuckets  # size of the output buckets
 
-    lo = torch.arange(numbuckets, device=dv, dtype=torch.long) * bsize # minimum index of each downbucket
+    lo = constant(range(0, numbuckets * bsize, bsize), torch.long, dv) # minimum index of each downbucket
     lo = lo[None, :, None].expand(bn, numbuckets, bsize).contiguous().view(bn, -1)
-    hi = torch.arange(numbuckets, device=dv, dtype=torch.long) * bsize + bsize//2  # minimum index of each upbucket
+    hi = constant(range(bsize//2, numbuckets * bsize, bsize), torch.long, dv)  # minimum index of each upbucket
     hi = hi[None, :, None].expand(bn, numbuckets, bsize).contiguous().view(bn, -1)
 
     upchoices   = offset.long()
@@ -1029,7 +1498,7 @@ def sample_offsets(batch, num, size, depth, cuda=False):
     numbuckets = 2 ** depth # number of buckets in the input
     bsize      = size // numbuckets  # size of the input buckets
 
-    ordered = torch.tensor([0,1], dtype=torch.uint8, device=dv)[None, None, None, :, None].expand(batch, num, numbuckets, 2, bsize // 2)
+    ordered = constant((0, 1), torch.bool, dv)[None, None, None, :, None].expand(batch, num, numbuckets, 2, bsize // 2)
     ordered = ordered.contiguous().view(batch, num, numbuckets, bsize)
 
     # shuffle the buckets
@@ -1040,54 +1509,17 @@ def sample_offsets(batch, num, size, depth, cuda=False):
     return ordered.contiguous().view(batch, num, -1)
 
 
-shufflecache = {}
-cache_size = 500_000
-
 def shuffle_rows(x):
-
-    r, c = x.size()
-
-    if c not in shufflecache:
-        cached = torch.zeros(cache_size, c, dtype=torch.long, device='cpu')
-        for i in range(cache_size):
-            cached[i, :] = torch.randperm(c)
-        shufflecache[c] = cached
-
-    cache = shufflecache[c]
-    rows = random.sample(range(cache_size), k=r)
-    sample = cache[rows, :]
-
-    if x.is_cuda:
-        sample = sample.cuda()
-
-    out = x.gather(dim=1, index=sample)
-
-    if x.is_cuda:
-        out = out.cuda()
-
-    return out
-
-def unique(tuples):
-    """
-    Assigns a single unique identifier to each tuple expressed in the row
-    :param tuples:
-    :return:
     """
-    b, s = tuples.size()
+    Shuffles the elements within each row of a matrix, independently for each row. The permutations are sampled by
+    sorting a matrix of uniform random keys.
 
-    if s == 2:
-        k1, k2 = tuples[:, 0], tuples[:, 1]
-
-        res = ((k1 + k2) * (k1 + k2 + 1)) / 2 + k2
-
-        return res[:, None]
-
-    sub = unique(tuples[:, 1:])
-
-    res = torch.cat([tuples[:, 0:1], sub], dim=1)
-
-    return unique(res)
+    :param x: A matrix
+    :return: A matrix of the same size
+    """
+    perms = torch.rand(x.size(), device=x.device).argsort(dim=1)
 
+    return x.gather(dim=1, index=perms)
 
 def xent(out, tgt):
     """
@@ -1118,7 +1550,7 @@ if __name__ == '__main__':
 #
 # #    print(sample_offsets(3, 4, 16, 3))
 # #
-# #     print(unique(torch.tensor( [[1,2,3,4],[4,3,2,1],[1,2,3,4]] )))
+# #     print(duplicates(torch.tensor( [[[1,2,3,4],[4,3,2,1],[1,2,3,4]]] )))
 # #
 # #
 #     indices = torch.tensor([[[0, 0], [1, 1]], [[0, 1], [1, 0]]])